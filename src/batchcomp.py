@@ -0,0 +1,235 @@
+"""
+binary_comp over arrays of category ids.
+
+A CategoryTable encodes the spine of every interned category as rows of
+arrays: the slash, the result and the argument at each level. The rules of
+grammar.py compare categories ignoring their features, so results and
+arguments are also kept as the ids of their feature-free forms, and the checks
+of the rules become comparisons between rows:
+
+    results, codes = batch_binary_comp(left_ids, right_ids)
+
+gives, for each pair, the id of the category that binary_comp derives and the
+code of its label (flattree.COMB_LABELS), or -1 for both when no rule applies.
+"""
+
+import numpy as np
+
+from category import CATEGORIES, Category
+from flattree import comb_code
+from grammar import CONJ, MAX_DEGREE, PUNC, _compose, composition_label
+
+# slash codes
+NO_SLASH, FORWARD, BACKWARD = 0, 1, 2
+SLASH_CODES: dict[str, int] = {"/": FORWARD, "\\": BACKWARD}
+
+
+class CategoryTable:
+    """
+    For level l of the spine of a category (the category itself, then its
+    result, and so on):
+
+        slash[id, l]         slash code of the functor at that level
+        result[id, l]        id of its result
+        plain_result[id, l]  id of its result without features
+        argument[id, l]      id of its argument without features
+
+    with NO_SLASH and -1 past the last argument, and per category `plain`, its
+    id without features, and `nargs`. `update` adds the categories interned
+    since the last update.
+    """
+
+    __slots__ = ("slash", "result", "plain_result", "argument", "plain", "nargs")
+
+    def __init__(self) -> None:
+        self.slash: np.ndarray = np.zeros((0, 1), dtype=np.int8)
+        self.result: np.ndarray = np.full((0, 1), -1, dtype=np.int32)
+        self.plain_result: np.ndarray = np.full((0, 1), -1, dtype=np.int32)
+        self.argument: np.ndarray = np.full((0, 1), -1, dtype=np.int32)
+        self.plain: np.ndarray = np.zeros(0, dtype=np.int32)
+        self.nargs: np.ndarray = np.zeros(0, dtype=np.int16)
+        self.update()
+
+    def __len__(self) -> int:
+        return len(self.plain)
+
+    def update(self) -> None:
+        # taking categories without features may intern more of them
+        plain: list[int] = []
+        rows: list[list[tuple[int, int, int, int]]] = []
+        i = len(self)
+        while i < len(CATEGORIES):
+            cat = CATEGORIES[i]
+            plain.append(cat.without_feature.id)
+            rows.append(
+                [
+                    (
+                        SLASH_CODES[functor.slash],
+                        functor.left.id,
+                        functor.left.without_feature.id,
+                        functor.right.without_feature.id,
+                    )
+                    for functor in cat.spine[: cat.nargs]
+                ]
+            )
+            i += 1
+        if not rows:
+            return
+
+        levels = max([self.slash.shape[1]] + [len(row) for row in rows])
+        new = np.full((len(rows), levels, 4), -1, dtype=np.int32)
+        new[:, :, 0] = NO_SLASH
+        for n, row in enumerate(rows):
+            if row:
+                new[n, : len(row)] = row
+
+        def _extend(old: np.ndarray, column: int, fill: int) -> np.ndarray:
+            if old.shape[1] < levels:
+                pad = np.full((len(old), levels - old.shape[1]), fill, old.dtype)
+                old = np.concatenate([old, pad], 1)
+            return np.concatenate([old, new[:, :, column].astype(old.dtype)])
+
+        self.slash = _extend(self.slash, 0, NO_SLASH)
+        self.result = _extend(self.result, 1, -1)
+        self.plain_result = _extend(self.plain_result, 2, -1)
+        self.argument = _extend(self.argument, 3, -1)
+        self.plain = np.concatenate([self.plain, np.array(plain, dtype=np.int32)])
+        self.nargs = np.concatenate(
+            [self.nargs, np.array([len(row) for row in rows], dtype=np.int16)]
+        )
+
+    @property
+    def levels(self) -> int:
+        return self.slash.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            column.nbytes
+            for column in (
+                self.slash,
+                self.result,
+                self.plain_result,
+                self.argument,
+                self.plain,
+                self.nargs,
+            )
+        )
+
+
+CATEGORY_TABLE = CategoryTable()
+
+# (direction, functor id, argument id, degree) -> id of the composed category;
+# the functor X/Y or X\Y is the left category of a forward composition
+_COMPOSED: dict[tuple[str, int, int, int], int] = {}
+
+
+def _composed(direction: str, functor: int, argument: int, degree: int) -> int:
+    key = (direction, functor, argument, degree)
+    result = _COMPOSED.get(key)
+    if result is None:
+        functor_cat = Category.from_id(functor)
+        argument_cat = Category.from_id(argument)
+        result = _COMPOSED[key] = _compose(argument_cat, functor_cat.left, degree).id
+    return result
+
+
+def _composition_degrees(
+    table: CategoryTable,
+    functor: np.ndarray,
+    argument: np.ndarray,
+    direction: str,
+) -> tuple[np.ndarray, np.ndarray]:
+    # the degree at which forward_composition or backward_composition composes
+    # each pair, harmonic and crossed (0: none); the rules take the lowest
+    # harmonic degree, or else the lowest crossed one
+    harmonic_slash = FORWARD if direction == ">" else BACKWARD
+    wanted = table.argument[functor, 0]
+    todo = table.slash[functor, 0] == harmonic_slash
+    harmonic = np.zeros(len(functor), dtype=np.int8)
+    crossed = np.zeros(len(functor), dtype=np.int8)
+    for n in range(1, min(MAX_DEGREE[direction], table.levels) + 1):
+        match = todo & (table.plain_result[argument, n - 1] == wanted)
+        if not match.any():
+            continue
+        is_harmonic = table.slash[argument, n - 1] == harmonic_slash
+        harmonic[match & is_harmonic & (harmonic == 0)] = n
+        crossed[match & ~is_harmonic & (crossed == 0)] = n
+    return harmonic, crossed
+
+
+def _binary_comp(
+    table: CategoryTable, left: np.ndarray, right: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    results = np.full(len(left), -1, dtype=np.int64)
+    codes = np.full(len(left), -1, dtype=np.int16)
+    todo = np.ones(len(left), dtype=bool)
+
+    def _apply(match: np.ndarray, result: np.ndarray, label: str) -> None:
+        # rules in the priority order of grammar.COMBINATORS
+        match &= todo
+        results[match] = result[match]
+        codes[match] = comb_code(label)
+        todo[match] = False
+
+    # fa, ba
+    _apply(
+        (table.slash[left, 0] == FORWARD)
+        & (table.argument[left, 0] == table.plain[right]),
+        table.result[left, 0],
+        ">",
+    )
+    _apply(
+        (table.slash[right, 0] == BACKWARD)
+        & (table.argument[right, 0] == table.plain[left]),
+        table.result[right, 0],
+        "<",
+    )
+
+    # forward_composition, backward_composition; the results are new
+    # categories
+    for direction, functor, argument in [(">", left, right), ("<", right, left)]:
+        harmonic, crossed = _composition_degrees(table, functor, argument, direction)
+        for degrees, is_crossed in [(harmonic, False), (crossed, True)]:
+            match = todo & (degrees > 0)
+            for i, n in zip(np.flatnonzero(match).tolist(), degrees[match].tolist()):
+                results[i] = _composed(direction, int(functor[i]), int(argument[i]), n)
+                codes[i] = comb_code(composition_label(direction, is_crossed, n))
+            todo[match] = False
+
+    # punc, conj
+    punc = np.array([cat.id for cat in PUNC])
+    _apply(np.isin(right, punc), left, "punc")
+    _apply(np.isin(left, punc), right, "punc")
+    _apply(table.plain[left] == CONJ.without_feature.id, right, ">")
+    return results, codes
+
+
+def batch_binary_comp(
+    left: np.ndarray, right: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    binary_comp(Category.from_id(l), Category.from_id(r)) for each pair of
+    `left` and `right`: the id of the result and the code of the label, -1
+    when no rule applies. The rules are checked once per distinct pair.
+    """
+    table = CATEGORY_TABLE
+    table.update()
+    left = np.asarray(left, dtype=np.int64)
+    right = np.asarray(right, dtype=np.int64)
+    pairs, inverse = np.unique(left * len(table) + right, return_inverse=True)
+    results, codes = _binary_comp(table, pairs // len(table), pairs % len(table))
+    inverse = inverse.ravel()
+    return results[inverse], codes[inverse]
+
+
+def binary_nodes(start: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    The binary nodes of postorder columns (FlatTree.start, or
+    FlatCorpus.absolute_start) with their left and right children.
+    """
+    nodes = np.arange(len(start))
+    right = nodes - 1
+    left = np.where(start < nodes, start[np.maximum(right, 0)] - 1, -1)
+    binary = (left >= start) & (start[np.maximum(left, 0)] - 1 < start)
+    return nodes[binary], left[binary], right[binary]
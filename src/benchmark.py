@@ -0,0 +1,581 @@
+"""
+Benchmarks for the category algebra and tree transforms.
+
+Usage (from src/):
+    python benchmark.py compose ../data/parse/Dundee.txt --against <revision>
+    python benchmark.py compose ../data/parse/Dundee.txt --against <revision> \
+        --random 200000
+    python benchmark.py rotate --sizes 10 100 1000 10000 --against <revision>
+    python benchmark.py pipeline ../data/parse/Dundee.txt
+    python benchmark.py forest ../data/parse/Dundee.txt --longest 10
+    python benchmark.py memo ../data/parse/BCCWJ-EyeTrack.txt --ja
+    python benchmark.py batch ../data/parse/Dundee.txt --random 200000
+    python benchmark.py align ../data/parse/BCCWJ-EyeTrack.txt --ja --against <revision>
+"""
+
+import argparse
+import importlib
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from types import ModuleType
+from typing import Callable, Optional
+
+from reader import read_auto
+
+
+def load_revision(revision: str, *names: str) -> dict[str, ModuleType]:
+    # import the modules `names` as they were at a git revision, isolated from
+    # the current ones, so that old and new implementations can be compared
+    root = subprocess.run(
+        ["git", "rev-parse", "--show-toplevel"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.strip()
+    tmpdir = tempfile.mkdtemp(prefix="benchmark-")
+    for name in names:
+        source = subprocess.run(
+            ["git", "show", f"{revision}:src/{name}.py"],
+            cwd=root,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        with open(os.path.join(tmpdir, f"{name}.py"), "w") as f:
+            f.write(source)
+
+    current = {name: sys.modules.pop(name, None) for name in names}
+    sys.path.insert(0, tmpdir)
+    try:
+        modules = {name: importlib.import_module(name) for name in names}
+    finally:
+        sys.path.remove(tmpdir)
+        for name, module in current.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+    return modules
+
+
+def timeit(func: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def corpus_pairs(filepath: str) -> list[tuple[str, str]]:
+    # category pairs that binary_comp sees while reading and rotating a corpus
+    pairs: list[tuple[str, str]] = []
+
+    def _rec(node) -> None:
+        if node.is_binary:
+            pairs.append((str(node.left.cat), str(node.right.cat)))
+            if node.right.is_binary:
+                pairs.append((str(node.left.cat), str(node.right.left.cat)))
+        for child in node.children or []:
+            _rec(child)
+
+    for tree in read_auto(filepath):
+        _rec(tree)
+    return pairs
+
+
+def random_pairs(count: int, seed: int = 0) -> list[tuple[str, str]]:
+    # random category pairs; half of them share an argument, with up to five
+    # more arguments on the composed side, so that every rule and degree of
+    # composition applies to some of them
+    rng = random.Random(seed)
+    atoms = ["S", "NP", "N", "S[dcl]", "PP"]
+    slashes = "/\\"
+
+    def _wrap(cat: str) -> str:
+        return f"({cat})" if "/" in cat or "\\" in cat else cat
+
+    def _random(depth: int) -> str:
+        if depth <= 0 or rng.random() < 0.3:
+            return rng.choice(atoms)
+        left, right = _random(depth - 1), _random(depth - 2)
+        return _wrap(left) + rng.choice(slashes) + _wrap(right)
+
+    pairs: list[tuple[str, str]] = []
+    for _ in range(count):
+        left, right = _random(5), _random(5)
+        if rng.random() < 0.5:
+            argument = _wrap(_random(2))
+            left = _wrap(_random(2)) + rng.choice(slashes) + argument
+            right = argument
+            for _ in range(rng.randint(0, 5)):
+                right = f"({right}){rng.choice(slashes)}{_wrap(_random(1))}"
+            if rng.random() < 0.5:
+                left, right = right, left
+        pairs.append((left, right))
+    return pairs
+
+
+def bench_compose(
+    filepath: str, against: str, repeat: int, num_random: int = 0
+) -> None:
+    import category
+    import grammar
+
+    old = load_revision(against, "category", "grammar")
+    pairs = corpus_pairs(filepath)
+
+    new_pairs, old_pairs = [], []
+    for left, right in pairs:
+        try:
+            old_left = old["category"].Category.from_string(left)
+            old_right = old["category"].Category.from_string(right)
+        except (RuntimeError, AssertionError):
+            continue
+        old_pairs.append((old_left, old_right))
+        new_pairs.append(
+            (category.Category.from_string(left), category.Category.from_string(right))
+        )
+
+    mismatches = 0
+    for (new_left, new_right), (old_left, old_right) in zip(new_pairs, old_pairs):
+        new_cat, new_comb = grammar.binary_comp(new_left, new_right)
+        old_cat, old_comb = old["grammar"].binary_comp(old_left, old_right)
+        mismatches += str(new_cat) != str(old_cat) or new_comb != old_comb
+
+    def _run(binary_comp, pairs) -> Callable[[], None]:
+        return lambda: [binary_comp(left, right) for left, right in pairs]
+
+    new_time = timeit(_run(grammar.binary_comp, new_pairs), repeat)
+    old_time = timeit(_run(old["grammar"].binary_comp, old_pairs), repeat)
+    print(f"pairs: {len(new_pairs)} ({len(pairs) - len(new_pairs)} skipped)")
+    print(f"mismatches: {mismatches}")
+    print(f"{against}: {old_time:.3f}s ({old_time / len(old_pairs) * 1e6:.2f}us/pair)")
+    print(f"current: {new_time:.3f}s ({new_time / len(new_pairs) * 1e6:.2f}us/pair)")
+    print(f"speedup: {old_time / new_time:.1f}x")
+    stats = grammar.comp_stats()
+    print(f"memo: {stats['hit_rate']:.1%} hits, {stats['table_size']} pairs")
+    for name, seconds in sorted(stats["rule_time"].items(), key=lambda i: -i[1]):
+        calls = stats["rule_calls"][name]
+        print(f"  {name:>5}: {calls:>7} calls {seconds * 1e3:8.2f}ms")
+
+    if num_random:
+        mismatches = 0
+        labels: dict[str, int] = {}
+        for left, right in random_pairs(num_random):
+            new_cat, new_comb = grammar.binary_comp(
+                category.Category.from_string(left),
+                category.Category.from_string(right),
+            )
+            old_cat, old_comb = old["grammar"].binary_comp(
+                old["category"].Category.from_string(left),
+                old["category"].Category.from_string(right),
+            )
+            mismatches += str(new_cat) != str(old_cat) or new_comb != old_comb
+            labels[str(new_comb)] = labels.get(str(new_comb), 0) + 1
+        print(f"random pairs: {num_random}, mismatches: {mismatches}")
+        print("  " + ", ".join(f"{label} {n}" for label, n in sorted(labels.items())))
+
+
+def right_branching(tree_module: ModuleType, n: int):
+    # S/S (S/S (... (S/S S))): every rotation succeeds, giving a left-branching
+    # tree of forward compositions
+    from category import Category
+
+    functor, argument = Category.from_string("S/S"), Category.from_string("S")
+    tree = tree_module.Tree(argument, None, "lex", "_")
+    for _ in range(n - 1):
+        leaf = tree_module.Tree(functor, None, "lex", "_")
+        tree = tree_module.Tree(argument, [leaf, tree], ">")
+    return tree
+
+
+def bench_rotate(sizes: list[int], against: Optional[str], repeat: int) -> None:
+    import tree
+
+    implementations = {"current": tree}
+    if against:
+        implementations[against] = load_revision(against, "tree")["tree"]
+
+    print(f"{'leaves':>8}" + "".join(f"{name:>16}" for name in implementations))
+    for n in sizes:
+        row = f"{n:>8}"
+        for module in implementations.values():
+            source = right_branching(module, n)
+            try:
+                seconds = timeit(lambda: module.rotate2left(source), repeat)
+                row += f"{seconds * 1e3:>13.2f}ms"
+            except RecursionError:
+                row += f"{'RecursionError':>16}"
+        print(row)
+
+
+def count_trees(func: Callable[[], object]) -> int:
+    # number of Tree objects constructed while running `func`
+    import tree
+
+    count = 0
+    init = tree.Tree.__init__
+
+    def _init(self, *args, **kwargs) -> None:
+        nonlocal count
+        count += 1
+        init(self, *args, **kwargs)
+
+    tree.Tree.__init__ = _init
+    try:
+        func()
+    finally:
+        tree.Tree.__init__ = init
+    return count
+
+
+def bench_pipeline(filepath: str, japanese: bool, repeat: int) -> None:
+    from count import CompositionCount
+    from incremental import simulate
+    from passes import EN_PREPROCESS, JA_PREPROCESS
+    from reader import read_parsedJaTree
+    from tree import apply_typeraise, en_apply_typeraise, rotate2left
+
+    if japanese:
+        trees = list(read_parsedJaTree(filepath))
+        raise_, pipeline = apply_typeraise, JA_PREPROCESS
+    else:
+        trees = list(read_auto(filepath))
+        raise_, pipeline = en_apply_typeraise, EN_PREPROCESS
+
+    def _sequential() -> list[str]:
+        counter = CompositionCount()
+        for tree in trees:
+            counter.traverse(rotate2left(raise_(tree)))
+        return counter.combs_lst
+
+    def _fused() -> list[str]:
+        counter = CompositionCount()
+        for tree in trees:
+            counter.traverse_pipeline(tree, pipeline)
+        return counter.combs_lst
+
+    def _incremental() -> list[str]:
+        combs: list[str] = []
+        for tree in trees:
+            for step in simulate(tree, pipeline):
+                combs.append("lex")
+                combs.extend(step.combinators)
+        return combs
+
+    print(f"trees: {len(trees)}")
+    expected = _sequential()
+    print(f"identical counts: {expected == _fused() == _incremental()}")
+    for name, func in [
+        ("sequential", _sequential),
+        ("fused", _fused),
+        ("incremental", _incremental),
+    ]:
+        seconds = timeit(func, repeat)
+        print(f"{name:>11}: {seconds:.3f}s {count_trees(func):>8} trees allocated")
+
+
+def bench_forest(
+    filepath: str, japanese: bool, longest: int, punctuation: bool, repeat: int
+) -> None:
+    from forest import Forest
+    from reader import read_parsedJaTree
+
+    trees = list(read_parsedJaTree(filepath) if japanese else read_auto(filepath))
+    trees.sort(key=lambda tree: len(tree.leaves), reverse=True)
+
+    print(
+        f"{'words':>6}{'nodes':>8}{'edges':>8}{'derivations':>13}"
+        f"{'chart':>10}{'counts':>10}{'E[Comp]':>9}{'max/word':>9}"
+    )
+    for tree in trees[:longest]:
+        forest = Forest(tree, punctuation=punctuation)
+        build = timeit(lambda: Forest(tree, punctuation=punctuation), repeat)
+        counts = timeit(forest.word_counts, repeat)
+        expected, _, high = forest.word_counts()
+        print(
+            f"{len(forest.tokens):>6}{len(forest):>8}{forest.num_edges:>8}"
+            f"{float(forest.num_derivations):>13.3g}"
+            f"{build * 1e3:>8.1f}ms{counts * 1e3:>8.1f}ms"
+            f"{expected.sum():>9.1f}{high.max():>9.0f}"
+        )
+
+
+def bench_memo(filepath: str, japanese: bool, size: int, repeat: int) -> None:
+    import numpy as np
+
+    from count import NodeTable
+    from passes import EN_PREPROCESS, JA_PREPROCESS
+    from reader import read_parsedJaTree
+    from tree import SubtreeCache
+
+    if japanese:
+        trees, pipeline = list(read_parsedJaTree(filepath)), JA_PREPROCESS
+    else:
+        trees, pipeline = list(read_auto(filepath)), EN_PREPROCESS
+
+    # one pass over the corpus with an empty cache, as a script would make
+    cache = SubtreeCache(size)
+    plain, cached = NodeTable(trees, pipeline), NodeTable(trees, pipeline, None, cache)
+    identical = plain.tokens == cached.tokens and all(
+        np.array_equal(getattr(plain, column), getattr(cached, column))
+        for column in ("comb", "cat", "arity", "tree", "token")
+    )
+    print(f"trees: {len(trees)}, nodes: {len(plain)}, identical: {identical}")
+    for kind, stats in cache.stats().items():
+        print(
+            f"{kind}: {stats['hit_rate']:6.1%} hits "
+            f"({stats['hits']} of {stats['hits'] + stats['misses']} subtrees)"
+        )
+    print(f"entries: {len(cache.entries)} of {size}")
+
+    uncached = timeit(lambda: NodeTable(trees, pipeline), repeat)
+    fresh = timeit(lambda: NodeTable(trees, pipeline, None, SubtreeCache(size)), repeat)
+    warm = timeit(lambda: NodeTable(trees, pipeline, None, cache), repeat)
+    print(f"{'uncached':>16}: {uncached:.3f}s")
+    print(f"{'empty cache':>16}: {fresh:.3f}s")
+    print(f"{'filled cache':>16}: {warm:.3f}s")
+
+
+def bench_batch(filepath: str, repeat: int, num_random: int = 0) -> None:
+    import numpy as np
+
+    from batchcomp import CATEGORY_TABLE, batch_binary_comp
+    from category import Category
+    from flattree import COMB_LABELS
+    from grammar import binary_comp
+
+    cats = [
+        (Category.from_string(left), Category.from_string(right))
+        for left, right in corpus_pairs(filepath) + random_pairs(num_random)
+    ]
+    left = np.array([left.id for left, _ in cats])
+    right = np.array([right.id for _, right in cats])
+
+    start = time.perf_counter()
+    results, codes = batch_binary_comp(left, right)
+    first = time.perf_counter() - start
+    mismatches = 0
+    for (left_cat, right_cat), result, code in zip(
+        cats, results.tolist(), codes.tolist()
+    ):
+        cat, comb = binary_comp(left_cat, right_cat)
+        expected = (cat.id, comb) if cat else (-1, None)
+        mismatches += expected != (result, COMB_LABELS[code] if code >= 0 else None)
+
+    loop = timeit(lambda: [binary_comp(left, right) for left, right in cats], repeat)
+    batch = timeit(lambda: batch_binary_comp(left, right), repeat)
+    print(f"pairs: {len(cats)}, mismatches: {mismatches}")
+    print(
+        f"table: {len(CATEGORY_TABLE)} categories, {CATEGORY_TABLE.levels} levels, "
+        f"{CATEGORY_TABLE.nbytes / 1024:.0f}KiB"
+    )
+    print(f"binary_comp: {loop:.3f}s ({loop / len(cats) * 1e6:.2f}us/pair)")
+    print(f"batch: {batch:.3f}s ({batch / len(cats) * 1e6:.2f}us/pair)")
+    print(f"first batch: {first:.3f}s")
+    print(f"speedup: {loop / batch:.1f}x")
+
+
+def surface_cases(tokens: list[str], seed: int = 0) -> dict[str, list]:
+    # surface words of one to three tokens each, as eye-tracking corpora split
+    # them, and variants that the aligner has to recover from
+    rng = random.Random(seed)
+    words: list = []
+    i = 0
+    while i < len(tokens):
+        n = rng.choice([1, 1, 1, 2, 3])
+        words.append("".join(tokens[i : i + n]))
+        i += n
+    middle = len(words) // 2
+    # a word from which a character is dropped
+    shortened = next(i for i in range(len(words) // 3, len(words)) if len(words[i]) > 2)
+    return {
+        "aligned": words,
+        "mismatch": words[:middle] + [words[middle] + "x"] + words[middle + 1 :],
+        "nan": words[:10] + [float("nan")] + words[11:],
+        "empty": words[:5] + [""] + words[5:40] + [""] + words[40:],
+        "prefix": words[:shortened] + [words[shortened][:-1]] + words[shortened + 1 :],
+        "merged": [words[0] + words[1]] + words[2:],
+        "split": [words[0][:1], words[0][1:]] + words[1:],
+        "short": words[:-3],
+        "long": words + ["extra", "", "words"],
+        "none": [],
+    }
+
+
+def bench_align(
+    filepath: str,
+    japanese: bool,
+    against: str,
+    sentences: int,
+    chunk_sizes: list[int],
+    seed: int,
+) -> None:
+    import pandas as pd
+
+    from count import CompositionCount
+    from flattree import FlatTree
+    from reader import read_parsedJaTree
+
+    old = load_revision(against, "count")["count"]
+    trees = list(read_parsedJaTree(filepath) if japanese else read_auto(filepath))
+    # the parse files mask the words, so the leaves get random ones
+    rng = random.Random(seed)
+    relabeled = []
+    for tree in trees[:sentences]:
+        flat = FlatTree.from_tree(tree)
+        flat.tokens = [
+            "".join(rng.choice("abcdeあいう") for _ in range(rng.randint(1, 4)))
+            for _ in flat.tokens
+        ]
+        relabeled.append(flat.to_tree())
+    tokens = [token for tree in relabeled for token in tree.tokens]
+
+    def _csv(make_csv, surface: list, trees, *options) -> tuple[str, list]:
+        # the csv that make_csv writes, and the spans it returns
+        unified_df = pd.DataFrame({"surface": surface}, dtype=object)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "counts.csv")
+            spans = make_csv(trees, path, unified_df, *options)
+            with open(path) as f:
+                return f.read(), spans
+
+    print(f"sentences: {len(relabeled)}, tokens: {len(tokens)}")
+    print(f"chunk sizes: {' '.join(map(str, chunk_sizes))}")
+    for case, surface in surface_cases(tokens, seed).items():
+        expected, expected_spans = _csv(
+            old.CompositionCount.make_csv, surface, relabeled
+        )
+        identical = True
+        all_spans = []
+        for chunk_size in chunk_sizes:
+            output, spans = _csv(
+                CompositionCount.make_csv, surface, iter(relabeled), None, chunk_size
+            )
+            identical &= output == expected
+            all_spans.append(spans)
+        if expected_spans is None:
+            # make_csv returned nothing before it reported the mismatches, so
+            # only the chunk sizes are compared with each other
+            same_spans = all(spans == all_spans[0] for spans in all_spans)
+            expected_spans = all_spans[0]
+        else:
+            same_spans = all(spans == expected_spans for spans in all_spans)
+        print(
+            f"{case:>9}: {len(surface):>5} words, identical: {identical}, "
+            f"same mismatches: {same_spans} ({len(expected_spans)})"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compose = subparsers.add_parser(
+        "compose", help="binary_comp against the implementation at a revision"
+    )
+    compose.add_argument("filepath", help="AUTO file to take category pairs from")
+    compose.add_argument("--against", required=True, help="git revision")
+    compose.add_argument("--repeat", type=int, default=3)
+    compose.add_argument(
+        "--random", type=int, default=0, help="also compare N random pairs"
+    )
+
+    rotate = subparsers.add_parser(
+        "rotate", help="rotate2left on synthetic right-branching trees"
+    )
+    rotate.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    rotate.add_argument("--against", help="git revision to compare with")
+    rotate.add_argument("--repeat", type=int, default=3)
+
+    pipeline = subparsers.add_parser(
+        "pipeline",
+        help="type-raise, rotate and count: in sequence, fused and simulated",
+    )
+    pipeline.add_argument("filepath", help="parse file")
+    pipeline.add_argument(
+        "--ja", action="store_true", help="the file is a Japanese CCGBank file"
+    )
+    pipeline.add_argument("--repeat", type=int, default=3)
+
+    forest = subparsers.add_parser(
+        "forest", help="packed forests of the longest sentences of a parse file"
+    )
+    forest.add_argument("filepath", help="parse file")
+    forest.add_argument(
+        "--ja", action="store_true", help="the file is a Japanese CCGBank file"
+    )
+    forest.add_argument("--longest", type=int, default=10)
+    forest.add_argument(
+        "--punctuation", action="store_true", help="keep punctuation attachment"
+    )
+    forest.add_argument("--repeat", type=int, default=3)
+
+    memo = subparsers.add_parser(
+        "memo", help="NodeTable columns with and without a SubtreeCache"
+    )
+    memo.add_argument("filepath", help="parse file")
+    memo.add_argument(
+        "--ja", action="store_true", help="the file is a Japanese CCGBank file"
+    )
+    memo.add_argument("--size", type=int, default=1 << 16, help="cache entries")
+    memo.add_argument("--repeat", type=int, default=3)
+
+    batch = subparsers.add_parser(
+        "batch", help="batch_binary_comp against binary_comp one pair at a time"
+    )
+    batch.add_argument("filepath", help="AUTO file to take category pairs from")
+    batch.add_argument("--repeat", type=int, default=3)
+    batch.add_argument("--random", type=int, default=0, help="add N random pairs")
+
+    align = subparsers.add_parser(
+        "align", help="streaming make_csv against make_csv at a revision"
+    )
+    align.add_argument("filepath", help="parse file")
+    align.add_argument(
+        "--ja", action="store_true", help="the file is a Japanese CCGBank file"
+    )
+    align.add_argument("--against", required=True, help="git revision")
+    align.add_argument("--sentences", type=int, default=200)
+    align.add_argument(
+        "--chunk-sizes",
+        type=int,
+        nargs="+",
+        default=[1, 2, 3, 7, 64, 1024, 65536],
+        help="tokens per chunk",
+    )
+    align.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == "compose":
+        bench_compose(args.filepath, args.against, args.repeat, args.random)
+    elif args.command == "rotate":
+        bench_rotate(args.sizes, args.against, args.repeat)
+    elif args.command == "pipeline":
+        bench_pipeline(args.filepath, args.ja, args.repeat)
+    elif args.command == "forest":
+        bench_forest(
+            args.filepath, args.ja, args.longest, args.punctuation, args.repeat
+        )
+    elif args.command == "memo":
+        bench_memo(args.filepath, args.ja, args.size, args.repeat)
+    elif args.command == "batch":
+        bench_batch(args.filepath, args.repeat, args.random)
+    elif args.command == "align":
+        bench_align(
+            args.filepath,
+            args.ja,
+            args.against,
+            args.sentences,
+            args.chunk_sizes,
+            args.seed,
+        )
+
+
+if __name__ == "__main__":
+    main()
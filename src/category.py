@@ -1,11 +1,26 @@
 # This script is based on https://github.com/masashi-y/depccg/blob/master/depccg/cat.py
 
-import copy
-import re
+import threading
+from functools import lru_cache
 from typing import Optional
 
-SLASH = re.compile(r"([/\\])")
-CAT_SPLIT = re.compile(r"([/\\]|[\[\]\(\)/\\])")
+# a treebank has only a few hundred distinct category strings
+PARSE_CACHE_SIZE: int = 4096
+DELIMITERS: frozenset[str] = frozenset("()[]/\\ ")
+
+# hash-consing table: each distinct category exists exactly once, and its
+# string form and hash are computed when it is first constructed.
+_INTERNED: dict[tuple, "Category"] = {}
+# interned categories by their `id`, in order of construction
+CATEGORIES: list["Category"] = []
+_INTERN_LOCK = threading.Lock()
+
+# structural predicates, computed once per category as the bits of `flags`
+S_HEADED = 1  # the leftmost atom is S: the category's string matches (*S
+ONE_S = 2  # "S" occurs exactly once in the category's string
+MANY_S = 4  # ... more than once
+MODIFIER = 8  # X/X
+POST_MODIFIER = 16  # X\X
 
 
 def inverse_dic(dictionary: dict):
@@ -13,6 +28,8 @@ def inverse_dic(dictionary: dict):
 
 
 class Feature:
+    __slots__ = ("value",)
+
     def __init__(self, value: Optional[str] = None):
         self.value: Optional[str] = value
 
@@ -29,7 +46,74 @@ class Feature:
         return hash(self.value)
 
 
+def _intern(key: tuple, cat: "Category") -> "Category":
+    with _INTERN_LOCK:
+        interned = _INTERNED.get(key)
+        if interned is not None:
+            return interned
+        object.__setattr__(cat, "id", len(CATEGORIES))
+        CATEGORIES.append(cat)
+        _INTERNED[key] = cat
+        return cat
+
+
+def _feature_value(feature: Optional[Feature]) -> Optional[str]:
+    return feature.value if feature is not None and feature.value else None
+
+
+def _s_flags(count: int) -> int:
+    if count == 0:
+        return 0
+    return ONE_S if count == 1 else MANY_S
+
+
+def _s_count(flags: int) -> int:
+    # exact up to 2, which is all that ONE_S and MANY_S need
+    return 1 if flags & ONE_S else 2 if flags & MANY_S else 0
+
+
 class Category:
+    # Categories are immutable, so copies can share the same object.
+    __slots__ = ()
+
+    def __setattr__(self, name: str, value: object) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __copy__(self) -> "Category":
+        return self
+
+    def __deepcopy__(self, memo: dict) -> "Category":
+        return self
+
+    def __str__(self) -> str:
+        return self._str
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    # categories compare ignoring their features, as the rules of grammar.py
+    # expect: equality is identity of the feature-free forms
+    def __eq__(self, other: object) -> bool:
+        if self is other:
+            return True
+        if isinstance(other, str):
+            other = Category.from_string(other)
+        elif not isinstance(other, Category):
+            return False
+        return (self._plain or self.without_feature) is (
+            other._plain or other.without_feature
+        )
+
+    def __xor__(self, other: object) -> bool:
+        if not isinstance(other, Category):
+            return False
+        return (self._plain or self.without_feature) is (
+            other._plain or other.without_feature
+        )
+
     def __truediv__(self, other: "Category") -> "Category":
         return Complex(self, "/", other)
 
@@ -46,79 +130,40 @@ class Category:
 
     @classmethod
     def from_string(cls, txt: str) -> "Category":
-        tokens = CAT_SPLIT.sub(r" \1 ", txt)
-        buffer = list(reversed([i for i in tokens.split(" ") if i != ""]))
-        stack = []
-
-        while len(buffer):
-            item = buffer.pop()
-            if item in "(":
-                stack.append(item)
-            elif item in ")":
-                y = stack.pop()
-                assert len(stack) > 0
-                if stack[-1] == "(" and item == ")":
-                    assert stack.pop() in "("
-                    stack.append(y)
-                else:
-                    f = stack.pop()
-                    x = stack.pop()
-                    assert stack.pop() in "("
-                    stack.append(Complex(x, f, y))
-            elif SLASH.match(item):
-                stack.append(item)
-            else:
-                if len(buffer) >= 3 and buffer[-1] == "[":
-                    buffer.pop()
-                    feature = Feature(buffer.pop())
-                    assert buffer.pop() == "]"
-                    stack.append(Basic(item, feature))
-                else:
-                    stack.append(Basic(item))
-
-        if len(stack) == 1:
-            return stack[0]
-        try:
-            x, f, y = stack
-            return Complex(x, f, y)
-        except ValueError:
-            raise RuntimeError(f"falied to parse category: {txt}")
+        return _parse(txt)
 
-    def clean_feature(self) -> None:
-        def _rec(cat: Category) -> Category:
-            if cat.is_complex:
-                _rec(cat.left)
-                _rec(cat.right)
-            else:
-                if isinstance(cat.feature, Feature):
-                    cat.feature = None
+    @classmethod
+    def from_id(cls, id: int) -> "Category":
+        return CATEGORIES[id]
 
-        _rec(self)
+    def clean_feature(self) -> "Category":
+        """
+        Categories are immutable; this returns the category without features.
+        """
+        return self.without_feature
 
     @property
     def without_feature(self) -> "Category":
-        cat_copy = copy.deepcopy(self)
-
-        def _rec(cat: Category) -> None:
-            if cat.is_complex:
-                _rec(cat.left)
-                _rec(cat.right)
+        # computed on first use and kept, as categories are immutable
+        plain = self._plain
+        if plain is None:
+            if self.is_complex:
+                plain = Complex(
+                    self.left.without_feature, self.slash, self.right.without_feature
+                )
             else:
-                if isinstance(cat.feature, Feature):
-                    cat.feature = None
-
-        _rec(cat_copy)
-        return cat_copy
+                plain = Basic(self.base)
+            object.__setattr__(self, "_plain", plain)
+        return plain
 
     @property
     def features(self) -> list[str]:
         def _rec(cat: Category) -> None:
+            if isinstance(cat.feature, Feature):
+                result.extend(str(cat.feature).split("]["))
             if cat.is_complex:
                 _rec(cat.left)
                 _rec(cat.right)
-            else:
-                if isinstance(cat.feature, Feature):
-                    result.append(str(cat.feature))
 
         result: list[str] = []
         _rec(self)
@@ -131,54 +176,60 @@ class Category:
             1. it includes just one 'S' category and
             2. it starts with 'S' category and
         """
-        s = str(cat)
-        return cat.is_complex and s.count("S") == 1 and re.match(r"\(*S", s) is not None
-
-
-class Basic(Category):
-    def __init__(self, base: str, feature: Optional[Feature] = None):
-        self.base: str = base
-        self.feature: Optional[Feature] = feature
-        self.t: Optional[Category] = None
-
-    def __str__(self) -> str:
-        if self.feature:
-            return f"{self.base}[{self.feature}]"
-        return self.base
-
-    def __eq__(self, other: object) -> bool:
-        if isinstance(other, str):
-            other = Category.from_string(other)
-        if isinstance(other, Complex):
-            return False
-        if self.feature and other.feature:
-            return self.base == other.base and self.feature and other.feature
-        else:
-            return self.base == other.base
-
-    def __xor__(self, other: object) -> bool:
-        if not isinstance(other, Basic):
-            return False
-        return self.base == other.base
-
-    def __hash__(self) -> int:
-        return hash(str(self))
-
-    @property
-    def is_basic(self):
-        return True
+        return cat.is_complex and cat.flags & (S_HEADED | ONE_S) == S_HEADED | ONE_S
 
     @property
     def is_modifier(self) -> bool:
-        return False
+        return bool(self.flags & MODIFIER)
 
     @property
     def is_post_modifier(self) -> bool:
-        return False
+        return bool(self.flags & POST_MODIFIER)
+
+
+class Basic(Category):
+    __slots__ = (
+        "base",
+        "feature",
+        "nargs",
+        "spine",
+        "flags",
+        "id",
+        "_str",
+        "_hash",
+        "_plain",
+    )
+
+    def __new__(cls, base: str, feature: Optional[Feature] = None) -> "Basic":
+        value = _feature_value(feature)
+        key = ("Basic", base, value)
+        cat = _INTERNED.get(key)
+        if cat is None:
+            cat = object.__new__(cls)
+            _set = object.__setattr__
+            _set(cat, "base", base)
+            _set(cat, "feature", Feature(value) if value else None)
+            _set(cat, "nargs", 0)
+            _set(cat, "spine", (cat,))
+            count = base.count("S") + (value.count("S") if value else 0)
+            _set(cat, "flags", (S_HEADED if base[:1] == "S" else 0) | _s_flags(count))
+            _set(cat, "_str", f"{base}[{value}]" if value else base)
+            _set(cat, "_hash", hash(cat._str))
+            _set(cat, "_plain", None)
+            cat = _intern(key, cat)
+        return cat
+
+    def __reduce__(self):
+        return Basic, (self.base, self.feature)
+
+    def replace(self, **changes) -> "Basic":
+        return Basic(
+            changes.get("base", self.base), changes.get("feature", self.feature)
+        )
 
     @property
-    def nargs(self) -> int:
-        return 0
+    def is_basic(self):
+        return True
 
     @property
     def to_latex(self) -> str:
@@ -188,58 +239,141 @@ class Basic(Category):
 
 
 class Complex(Category):
-    def __init__(self, left: str | Category, slash: str, right: str | Category):
-        self.left: Category = (
-            Category.from_string(left) if isinstance(left, str) else left
-        )
-        self.slash: str = slash
-        self.right: Category = (
-            Category.from_string(right) if isinstance(right, str) else right
-        )
-
-    def __str__(self) -> str:
-        def _str(cat):
-            if isinstance(cat, Complex):
-                return f"({cat})"
-            return str(cat)
-
-        return _str(self.left) + self.slash + _str(self.right)
-
-    def __eq__(self, other: object) -> bool:
-        if isinstance(other, str):
-            other = Category.from_string(other)
-        elif not isinstance(other, Complex):
-            return False
-        return (
-            self.left == other.left
-            and self.slash == other.slash
-            and self.right == other.right
-        )
-
-    def __xor__(self, other: object) -> bool:
-        if not isinstance(other, Complex):
-            return False
-        return (
-            self.left ^ other.left
-            and self.slash == other.slash
-            and self.right ^ other.right
+    __slots__ = (
+        "left",
+        "slash",
+        "right",
+        "feature",
+        "nargs",
+        "spine",
+        "flags",
+        "id",
+        "_str",
+        "_hash",
+        "_plain",
+    )
+
+    def __new__(
+        cls,
+        left: str | Category,
+        slash: str,
+        right: str | Category,
+        feature: Optional[Feature] = None,
+    ) -> "Complex":
+        left = Category.from_string(left) if isinstance(left, str) else left
+        right = Category.from_string(right) if isinstance(right, str) else right
+        value = _feature_value(feature)
+        key = ("Complex", id(left), slash, id(right), value)
+        cat = _INTERNED.get(key)
+        if cat is None:
+            cat = object.__new__(cls)
+            _set = object.__setattr__
+            _set(cat, "left", left)
+            _set(cat, "slash", slash)
+            _set(cat, "right", right)
+            _set(cat, "feature", Feature(value) if value else None)
+            _set(cat, "nargs", left.nargs + 1)
+            # the category, then its results after stripping each argument
+            _set(cat, "spine", (cat,) + left.spine)
+            count = _s_count(left.flags) + _s_count(right.flags)
+            count += value.count("S") if value else 0
+            flags = (left.flags & S_HEADED) | _s_flags(count)
+            if left == right:
+                flags |= MODIFIER if slash == "/" else POST_MODIFIER
+            _set(cat, "flags", flags)
+
+            def _str(c: Category) -> str:
+                if isinstance(c, Complex) and not c.feature:
+                    return f"({c})"
+                return str(c)
+
+            s = _str(left) + slash + _str(right)
+            _set(cat, "_str", f"({s})[{value}]" if value else s)
+            _set(cat, "_hash", hash(cat._str))
+            _set(cat, "_plain", None)
+            cat = _intern(key, cat)
+        return cat
+
+    def __reduce__(self):
+        return Complex, (self.left, self.slash, self.right, self.feature)
+
+    def with_result(self, result: Category, depth: int = 1) -> "Complex":
+        """
+        Replace the category reached by stripping `depth` arguments with
+        `result`. Only the `depth` nodes of the spine are rebuilt; every
+        argument is shared with `self`.
+        """
+        if depth == 1:
+            return self.replace(left=result)
+        return self.replace(left=self.left.with_result(result, depth - 1))
+
+    def replace(self, **changes) -> "Complex":
+        return Complex(
+            changes.get("left", self.left),
+            changes.get("slash", self.slash),
+            changes.get("right", self.right),
+            changes.get("feature", self.feature),
         )
 
-    def __hash__(self) -> int:
-        return hash(str(self))
-
     @property
     def is_complex(self):
         return True
 
-    @property
-    def is_modifier(self) -> bool:
-        return self.left == self.right and self.slash == "/"
-
-    @property
-    def is_post_modifier(self) -> bool:
-        return self.left == self.right and self.slash == "\\"
 
-    @property
-    def nargs(self) -> int:
-        return 1 + self.left.nargs
+def _scan_feature(txt: str, i: int) -> tuple[Optional[Feature], int]:
+    # a category may carry several features, e.g. S[dcl][conj]
+    values = []
+    while i < len(txt) and txt[i] == "[":
+        end = txt.find("]", i)
+        if end < 0:
+            raise RuntimeError(f"falied to parse category: {txt}")
+        values.append(txt[i + 1 : end])
+        i = end + 1
+    return (Feature("][".join(values)) if values else None), i
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse(txt: str) -> Category:
+    stack: list = []
+
+    def _push(cat: Category) -> None:
+        # slashes are left-associative: reduce as soon as the argument is read
+        while stack and isinstance(stack[-1], str) and stack[-1] != "(":
+            slash = stack.pop()
+            cat = Complex(stack.pop(), slash, cat)
+        stack.append(cat)
+
+    i, n = 0, len(txt)
+    while i < n:
+        char = txt[i]
+        if char == "(":
+            stack.append(char)
+            i += 1
+        elif char == ")":
+            if len(stack) < 2 or not isinstance(stack[-1], Category):
+                raise RuntimeError(f"falied to parse category: {txt}")
+            cat = stack.pop()
+            stack.pop()
+            feature, i = _scan_feature(txt, i + 1)
+            _push(cat.replace(feature=feature) if feature else cat)
+        elif char == "/" or char == "\\":
+            if not stack or not isinstance(stack[-1], Category):
+                raise RuntimeError(f"falied to parse category: {txt}")
+            stack.append(char)
+            i += 1
+        elif char == " ":
+            i += 1
+        else:
+            end = i + 1
+            while end < n and txt[end] not in DELIMITERS:
+                end += 1
+            base = txt[i:end]
+            feature, i = _scan_feature(txt, end)
+            _push(Basic(base, feature))
+    if len(stack) != 1 or not isinstance(stack[0], Category):
+        raise RuntimeError(f"falied to parse category: {txt}")
+    return stack[0]
+
+
+def parse_cache_info():
+    return _parse.cache_info()
@@ -1,16 +1,124 @@
-import pandas as pd
+import re
+from collections import Counter
+from functools import partial
+from typing import Callable, Iterable, Iterator, Optional
+
 import numpy as np
 
-from tree import Tree
-from reader import COMBINATORS
+from category import Category
+from flattree import COMB_LABELS, comb_code
+from tree import SubtreeCache, Tree
+from reader import COMBINATORS, imap_lines, parse_auto_line, parse_ja_line, read_lines
+from passes import Pipeline
+
+COUNT_COLUMNS: list[str] = ["app", "comp", "tr", "others", "nodecount"]
+# tokens per chunk in CompositionCount.iter_token_counts
+CHUNK_SIZE: int = 1 << 16
+# the largest subtrees, in nodes, whose columns NodeTable caches
+CACHED_SUBTREE_NODES: int = 64
+
+
+class CombinatorCounter:
+    """
+    Exact combinator frequencies: the combinator of every internal node of
+    the derivations added, optionally per sentence and per category pair,
+    i.e. (combinator, left child, right child) with "" as the right child of
+    unary nodes.
+    """
+
+    def __init__(self, by_sentence: bool = False, by_pair: bool = False) -> None:
+        self.counts: Counter[str] = Counter()
+        self.by_sentence: Optional[list[Counter[str]]] = [] if by_sentence else None
+        self.by_pair: Optional[Counter[tuple[str, str, str]]] = (
+            Counter() if by_pair else None
+        )
+
+    def add(self, tree: Tree) -> None:
+        sentence: Counter[str] = Counter()
+        stack: list[Tree] = [tree]
+        while stack:
+            node = stack.pop()
+            if not node.children:
+                continue
+            sentence[node.comb] += 1
+            if self.by_pair is not None:
+                left = str(node.children[0].cat)
+                right = str(node.children[1].cat) if node.is_binary else ""
+                self.by_pair[node.comb, left, right] += 1
+            stack.extend(node.children)
+        self.counts.update(sentence)
+        if self.by_sentence is not None:
+            self.by_sentence.append(sentence)
+
+    def merge(self, other: "CombinatorCounter") -> None:
+        # `other` counted the sentences that follow the ones of `self`
+        self.counts.update(other.counts)
+        if self.by_sentence is not None:
+            self.by_sentence.extend(other.by_sentence)
+        if self.by_pair is not None:
+            self.by_pair.update(other.by_pair)
+
+
+def _count_lines(
+    lines: list[str],
+    parse: Callable[[str], Tree],
+    by_sentence: bool,
+    by_pair: bool,
+) -> CombinatorCounter:
+    counter = CombinatorCounter(by_sentence, by_pair)
+    for line in lines:
+        counter.add(parse(line))
+    return counter
+
+
+def _batches(lines: Iterator[str], size: int) -> Iterator[list[str]]:
+    batch: list[str] = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 
+def count_file(
+    input_path: str,
+    parse: Optional[Callable[[str], Tree]] = None,
+    processes: Optional[int] = None,
+    chunksize: int = 256,
+    by_sentence: bool = False,
+    by_pair: bool = False,
+    ja: bool = False,
+) -> CombinatorCounter:
+    """
+    Count the combinators of the derivations of a parse file in one pass.
+    `parse` reads a derivation from a line: by default, an AUTO derivation,
+    or with `ja` one of the Japanese CCGBank. With `processes`, batches of
+    `chunksize` lines are parsed and counted by a process pool, and `parse`
+    must be a module-level function.
+    """
+    parse = parse or (parse_ja_line if ja else parse_auto_line)
+    lines = read_lines(input_path)
+    if processes is None:
+        return _count_lines(lines, parse, by_sentence, by_pair)
+    counter = CombinatorCounter(by_sentence, by_pair)
+    count = partial(_count_lines, parse=parse, by_sentence=by_sentence, by_pair=by_pair)
+    for batch_counter in imap_lines(count, _batches(lines, chunksize), processes, 1):
+        counter.merge(batch_counter)
+    return counter
 
-def count_combinators(input_path: str, output_path: str) -> None:
-    with open(input_path, "r") as input:
-        text: str = input.read()
-        counts: dict[str, int] = {combinator: 0 for combinator in COMBINATORS}
-        for combinator in COMBINATORS:
-            counts[combinator] = text.count(combinator)
+
+def count_combinators(
+    input_path: str,
+    output_path: str,
+    parse: Optional[Callable[[str], Tree]] = None,
+    processes: Optional[int] = None,
+    ja: bool = False,
+) -> None:
+    counter = count_file(input_path, parse, processes, ja=ja)
+    counts: dict[str, int] = {combinator: 0 for combinator in COMBINATORS}
+    counts.update(counter.counts)
     counts_sorted: list[tuple[str, int]] = sorted(
         counts.items(), key=lambda i: i[1], reverse=True
     )
@@ -35,104 +143,455 @@ class CompositionCount:
                 self.traverse(node.right)
                 self.combs_lst.append(node.comb)
 
+    def traverse_pipeline(self, tree: Tree, pipeline: Pipeline) -> None:
+        # same as self.traverse(pipeline.run(tree)), without building the tree
+        self.combs_lst.extend(node.comb for node in pipeline.postorder(tree))
+
     @staticmethod
-    def make_csv(trees: list[Tree], output_path: str, unified_df) -> None:
-        words: list[str] = []
-        self = CompositionCount()
-        for tree in trees:
-            self.traverse(tree)
-            words += tree.tokens
-        stack: list[str] = ["lex"]
-        output_list: list[list[str]] = []
-        for i in self.combs_lst:
-            if i == "lex":
-                output_list.append(stack)
-                stack = ["lex"]
-            else:
-                stack.append(i)
-        output_list.append(stack)
-        output_list = output_list[1:]
-
-        app_lst = []
-        comp_lst = []
-        tr_lst = []
-        others_lst = []
-        nd_lst = []
-        app = 0
-        comp = 0
-        tr = 0
-        others = 0
-        nd = 0
-        for comb_lst in output_list:
-            for comb in comb_lst:
-                comb_type = clasify_combs(comb)
-                match comb_type:
-                    case "App":
-                        app += 1
-                    case "Comp":
-                        comp += 1
-                    case "TR":
-                        tr += 1
-                    case "Others":
-                        others += 1
-                    case "lex":
-                        continue
-            nd = app + comp + tr + others
-            app_lst.append(app)
-            comp_lst.append(comp)
-            tr_lst.append(tr)
-            others_lst.append(others)
-            nd_lst.append(nd)
-            app = 0
-            comp = 0
-            tr = 0
-            others = 0
-            nd = 0
-
-        app_count = np.array(app_lst)
-        comp_count = np.array(comp_lst)
-        tr_count = np.array(tr_lst)
-        others_count = np.array(others_lst)
-        nd_count = np.array(nd_lst)
-        words = np.array(words)
-        df = pd.DataFrame(
-            np.stack(
-                [words, app_count, comp_count, tr_count, others_count, nd_count], 1
-            ),
-            columns=["token", "app", "comp", "tr", "others", "nodecount"],
-        )
+    def token_metrics(
+        tree: Tree,
+        metrics: Iterable[str] = COUNT_COLUMNS,
+        pipeline: Optional[Pipeline] = None,
+    ) -> dict[str, np.ndarray]:
+        # a column of each metric for the tokens of `tree`, from one traversal
+        return _compute_metrics(NodeTable([tree], pipeline), metrics)
+
+    @staticmethod
+    def iter_token_counts(
+        trees: Iterable[Tree],
+        pipeline: Optional[Pipeline] = None,
+        chunk_size: int = CHUNK_SIZE,
+        metrics: list[str] = COUNT_COLUMNS,
+        cache: Optional[SubtreeCache] = None,
+    ) -> Iterator[tuple[list[str], dict[str, np.ndarray]]]:
+        """
+        The tokens of `trees` and their metrics, in chunks of whole sentences
+        of about `chunk_size` tokens. The trees are read one at a time, and
+        the metrics of a chunk are computed at once. `cache` is shared by the
+        chunks (see NodeTable).
+        """
+        trees = iter(trees)
+        while True:
+            table = NodeTable(trees, pipeline, chunk_size, cache)
+            if len(table) == 0:
+                return
+            yield table.tokens, _compute_metrics(table, metrics)
 
-        for col in ["app", "comp", "tr", "others", "nodecount", "num_of_words"]:
-            unified_df[col] = 0
-
-        idx = 0
-        for _, row in unified_df.iterrows():
-            surface = row["surface"]
-            tokens = []
-            app_sum = 0
-            comp_sum = 0
-            tr_sum = 0
-            others_sum = 0
-            nodecount_sum = 0
-
-            while "".join(tokens) != surface and idx < len(df):
-                tokens.append(df.iloc[idx]["token"])
-                app_sum += int(df.iloc[idx]["app"])
-                comp_sum += int(df.iloc[idx]["comp"])
-                tr_sum += int(df.iloc[idx]["tr"])
-                others_sum += int(df.iloc[idx]["others"])
-                nodecount_sum += int(df.iloc[idx]["nodecount"])
-                idx += 1
-
-            if "".join(tokens) == surface:
-                unified_df.at[_, "app"] = app_sum
-                unified_df.at[_, "comp"] = comp_sum
-                unified_df.at[_, "tr"] = tr_sum
-                unified_df.at[_, "others"] = others_sum
-                unified_df.at[_, "nodecount"] = nodecount_sum
-                unified_df.at[_, "num_of_words"] = len(tokens)
+    @staticmethod
+    def make_csv(
+        trees: Iterable[Tree],
+        output_path: str,
+        unified_df,
+        pipeline: Optional[Pipeline] = None,
+        chunk_size: int = CHUNK_SIZE,
+        metrics: list[str] = COUNT_COLUMNS,
+        cache: Optional[SubtreeCache] = None,
+    ) -> list[tuple[int, int, int, int]]:
+        # `trees` can be a generator such as read_auto(...): only a chunk of
+        # tokens is kept in memory at a time. With `pipeline`, the trees are
+        # counted as transformed by it. `metrics` are names of METRICS, or
+        # "rule:<combinator>". Returns the spans of surface words that the
+        # tokens could not be aligned with (see SurfaceAligner).
+        aligner = SurfaceAligner(unified_df["surface"].tolist(), metrics)
+        for tokens, columns in CompositionCount.iter_token_counts(
+            trees, pipeline, chunk_size, metrics, cache
+        ):
+            aligner.feed(tokens, columns)
+        aligner.finish()
+
+        for name in metrics:
+            unified_df[name] = aligner.columns[name]
+        unified_df["num_of_words"] = aligner.num_of_words
 
         unified_df.to_csv(output_path, index=False)
+        return aligner.mismatches
+
+
+class NodeTable:
+    """
+    The nodes of trees in postorder, as the arrays that all metrics are
+    computed from: combinator codes (flattree.COMB_LABELS), category ids,
+    numbers of children, the tree of each node and the token that each node
+    comes after, counting tokens across the trees. With `max_tokens`, trees
+    are taken from `trees` only until there are that many tokens. With
+    `cache`, the columns of subtrees that the pipeline leaves to the caller
+    (see Pipeline.postorder) are looked up by their structure, and those of
+    up to CACHED_SUBTREE_NODES nodes are cached.
+    """
+
+    __slots__ = ("comb", "cat", "arity", "tree", "token", "tokens", "_class_counts")
+
+    def __init__(
+        self,
+        trees: Iterable[Tree],
+        pipeline: Optional[Pipeline] = None,
+        max_tokens: Optional[int] = None,
+        cache: Optional[SubtreeCache] = None,
+    ) -> None:
+        pipeline = pipeline or Pipeline()
+        combs: list[int] = []
+        cats: list[int] = []
+        arities: list[int] = []
+        tree_ids: list[int] = []
+        self.tokens: list[str] = []
+        skip: Optional[Callable[[Tree], bool]] = None
+        done: Optional[Callable[[Tree], None]] = None
+        if cache is not None:
+            kind = pipeline.name
+            # where the columns of each subtree being computed start
+            starts: dict[int, int] = {}
+
+            def _skip(node: Tree) -> bool:
+                columns = cache.get(kind, node.structure)
+                if columns is None:
+                    starts[id(node)] = len(combs)
+                    return False
+                node_combs, node_cats, node_arities = columns
+                combs.extend(node_combs)
+                cats.extend(node_cats)
+                arities.extend(node_arities)
+                self.tokens.extend(node.tokens)
+                return True
+
+            def _done(node: Tree) -> None:
+                start = starts.pop(id(node))
+                if len(combs) - start <= CACHED_SUBTREE_NODES:
+                    columns = (combs[start:], cats[start:], arities[start:])
+                    cache.put(kind, node.structure, columns)
+
+            skip, done = _skip, _done
+
+        for i, tree in enumerate(trees):
+            start = len(combs)
+            for node in pipeline.postorder(tree, skip, done):
+                combs.append(comb_code(node.comb))
+                cats.append(node.cat.id)
+                if node.children:
+                    arities.append(len(node.children))
+                else:
+                    arities.append(0)
+                    self.tokens.append(node.token)
+            tree_ids.extend([i] * (len(combs) - start))
+            if max_tokens is not None and len(self.tokens) >= max_tokens:
+                break
+        self.comb: np.ndarray = np.array(combs, dtype=np.int16)
+        self.cat: np.ndarray = np.array(cats, dtype=np.int32)
+        self.arity: np.ndarray = np.array(arities, dtype=np.int8)
+        self.tree: np.ndarray = np.array(tree_ids, dtype=np.int32)
+        self.token: np.ndarray = np.cumsum(self.arity == 0) - 1
+        self._class_counts: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.comb)
+
+    @property
+    def ntokens(self) -> int:
+        return len(self.tokens)
+
+    @property
+    def class_counts(self) -> np.ndarray:
+        # the number of nodes of each of COMB_CLASSES that each token completes
+        if self._class_counts is None:
+            classes = comb_table(comb_class, np.int8)[self.comb]
+            index = self.token * len(COMB_CLASSES) + classes
+            counts = np.bincount(index, minlength=self.ntokens * len(COMB_CLASSES))
+            self._class_counts = counts.reshape(self.ntokens, len(COMB_CLASSES))
+        return self._class_counts
+
+    def count(self, mask: np.ndarray) -> np.ndarray:
+        # the number of nodes in `mask` that each token completes
+        return np.bincount(self.token[mask], minlength=self.ntokens)
+
+    def maximum(self, values: np.ndarray) -> np.ndarray:
+        # the maximum of `values` over the nodes that each token completes
+        result = np.zeros(self.ntokens, dtype=values.dtype)
+        np.maximum.at(result, self.token, values)
+        return result
+
+    def last(self, values: np.ndarray) -> np.ndarray:
+        # `values` at the last node that each token completes
+        ends = np.searchsorted(self.token, np.arange(self.ntokens), "right")
+        return values[ends - 1]
+
+
+def _compute_metrics(table: NodeTable, metrics: Iterable[str]) -> dict[str, np.ndarray]:
+    columns: dict[str, np.ndarray] = {}
+    for name in metrics:
+        metric = get_metric(name)
+        columns[name] = np.asarray(metric.compute(table), dtype=metric.dtype)
+    return columns
+
+
+def comb_table(func: Callable[[str], object], dtype=np.int64) -> np.ndarray:
+    """
+    `func` of each combinator label, indexed by combinator code. Tables are
+    cached by `func`, which should thus be a module-level function.
+    """
+    key = (func, np.dtype(dtype))
+    table = _COMB_TABLES.get(key)
+    if table is None or len(table) < len(COMB_LABELS):
+        table = np.array([func(label) for label in COMB_LABELS], dtype=dtype)
+        _COMB_TABLES[key] = table
+    return table
+
+
+_COMB_TABLES: dict[tuple, np.ndarray] = {}
+
+# the classes of clasify_combs, by class code
+COMB_CLASSES: list[str] = ["App", "Comp", "TR", "Others", "lex"]
+
+
+def comb_class(label: str) -> int:
+    return COMB_CLASSES.index(clasify_combs(label))
+
+
+class Metric:
+    """
+    A per-token column: `compute` gives its values for the tokens of a
+    NodeTable, and `combine` ("sum", "max" or "last") how the values of the
+    tokens of a surface word are combined.
+    """
+
+    __slots__ = ("name", "compute", "dtype", "combine")
+
+    def __init__(
+        self,
+        name: str,
+        compute: Callable[[NodeTable], np.ndarray],
+        dtype=np.int64,
+        combine: str = "sum",
+    ) -> None:
+        assert combine in {"sum", "max", "last"}, f"unknown combine: {combine}"
+        self.name: str = name
+        self.compute: Callable[[NodeTable], np.ndarray] = compute
+        self.dtype: np.dtype = np.dtype(dtype)
+        self.combine: str = combine
+
+
+METRICS: dict[str, Metric] = {}
+
+
+def register_metric(name: str, dtype=np.int64, combine: str = "sum") -> Callable:
+    def _register(compute: Callable[[NodeTable], np.ndarray]) -> Callable:
+        METRICS[name] = Metric(name, compute, dtype, combine)
+        return compute
+
+    return _register
+
+
+def get_metric(name: str) -> Metric:
+    # "rule:<combinator>" counts the nodes of that combinator
+    metric = METRICS.get(name)
+    if metric is None and name.startswith("rule:"):
+        label = name[len("rule:") :]
+        metric = METRICS[name] = Metric(
+            name, lambda table: table.count(table.comb == comb_code(label))
+        )
+    assert metric is not None, f"unknown metric: {name}"
+    return metric
+
+
+def _composition_degree(label: str) -> int:
+    if clasify_combs(label) != "Comp":
+        return 0
+    match = re.fullmatch(r"[<>]Bx?(\d*)", label)
+    return int(match.group(1) or 1) if match else 1
+
+
+_CAT_SIZES: dict[int, int] = {}
+
+
+def category_size(cat: Category) -> int:
+    # the number of basic categories in `cat`
+    size = _CAT_SIZES.get(cat.id)
+    if size is None:
+        size = 1 if cat.is_basic else category_size(cat.left) + category_size(cat.right)
+        _CAT_SIZES[cat.id] = size
+    return size
+
+
+@register_metric("app")
+def _app(table: NodeTable) -> np.ndarray:
+    return table.class_counts[:, COMB_CLASSES.index("App")]
+
+
+@register_metric("comp")
+def _comp(table: NodeTable) -> np.ndarray:
+    return table.class_counts[:, COMB_CLASSES.index("Comp")]
+
+
+@register_metric("tr")
+def _tr(table: NodeTable) -> np.ndarray:
+    return table.class_counts[:, COMB_CLASSES.index("TR")]
+
+
+@register_metric("others")
+def _others(table: NodeTable) -> np.ndarray:
+    return table.class_counts[:, COMB_CLASSES.index("Others")]
+
+
+@register_metric("nodecount")
+def _nodecount(table: NodeTable) -> np.ndarray:
+    return table.class_counts[:, : COMB_CLASSES.index("lex")].sum(axis=1)
+
+
+@register_metric("max_degree", combine="max")
+def _max_degree(table: NodeTable) -> np.ndarray:
+    return table.maximum(comb_table(_composition_degree)[table.comb])
+
+
+@register_metric("stack_depth", combine="max")
+def _stack_depth(table: NodeTable) -> np.ndarray:
+    # constituents on the stack of a shift-reduce parser after each token and
+    # the reductions it completes; each earlier tree left its root on it
+    return table.last(np.cumsum(1 - table.arity.astype(np.int64)) - table.tree)
+
+
+@register_metric("cat_size", combine="max")
+def _cat_size(table: NodeTable) -> np.ndarray:
+    leaves = table.cat[table.arity == 0].tolist()
+    return np.array([category_size(Category.from_id(cat)) for cat in leaves])
+
+
+class SurfaceAligner:
+    """
+    Align tokens with surface words greedily, as the tokens are fed: each
+    surface word takes the following tokens up to the first ones that
+    concatenate to it, and gets the values of the metrics of their tokens
+    combined. From a surface word that the tokens do not concatenate to, the
+    rest of the words are left with zeros, and reported in `mismatches` as
+    (first row, end row, first token, end token).
+    """
+
+    def __init__(self, surfaces: list[str], metrics: list[str] = COUNT_COLUMNS) -> None:
+        self.valid: np.ndarray = np.array(
+            [isinstance(surface, str) for surface in surfaces], dtype=bool
+        )
+        self.surfaces: list[str] = [
+            surface if isinstance(surface, str) else "" for surface in surfaces
+        ]
+        self.surface_ends: np.ndarray = np.cumsum(
+            [len(surface) for surface in self.surfaces], dtype=np.int64
+        )
+        self.metrics: list[Metric] = [get_metric(name) for name in metrics]
+        self.columns: dict[str, np.ndarray] = {
+            metric.name: np.zeros(len(surfaces), dtype=metric.dtype)
+            for metric in self.metrics
+        }
+        self.num_of_words: np.ndarray = np.zeros(len(surfaces), dtype=np.int64)
+        self.mismatches: list[tuple[int, int, int, int]] = []
+        self.row: int = 0
+        self.ntokens: int = 0
+        # tokens fed but not yet aligned, and their metrics
+        self._tokens: list[str] = []
+        self._values: dict[str, np.ndarray] = {
+            metric.name: np.zeros(0, dtype=metric.dtype) for metric in self.metrics
+        }
+        self._failed_at: Optional[int] = None
+
+    def feed(self, tokens: list[str], columns: dict[str, np.ndarray]) -> None:
+        self.ntokens += len(tokens)
+        if self._failed_at is None:
+            self._tokens.extend(tokens)
+            for name, values in self._values.items():
+                self._values[name] = np.concatenate([values, columns[name]])
+            self._align(final=False)
+
+    def finish(self) -> None:
+        if self._failed_at is None:
+            self._align(final=True)
+        if self._failed_at is not None:
+            self.mismatches.append(
+                (self.row, len(self.surfaces), self._failed_at, self.ntokens)
+            )
+
+    def _align(self, final: bool) -> None:
+        n_rows, row = len(self.surfaces), self.row
+        if final:
+            stop = n_rows
+        else:
+            # the surface words that end within the pending tokens, and one more
+            base = self.surface_ends[row - 1] if row else 0
+            chars = base + sum(len(token) for token in self._tokens)
+            stop = min(
+                n_rows, int(np.searchsorted(self.surface_ends, chars, "right")) + 1
+            )
+        ends, n_aligned, incomplete = _align_prefix(
+            self._tokens, self.surfaces[row:stop], self.valid[row:stop]
+        )
+        begins = np.concatenate([[0], ends[:-1]]).astype(np.int64)
+        for metric in self.metrics:
+            values = _combine(self._values[metric.name], begins, ends, metric.combine)
+            self.columns[metric.name][row : row + n_aligned] = values
+        self.num_of_words[row : row + n_aligned] = ends - begins
+        self.row += n_aligned
+
+        first = self.ntokens - len(self._tokens)
+        consumed = int(ends[-1]) if n_aligned else 0
+        if self.row < n_rows and (final or (row + n_aligned < stop and not incomplete)):
+            self._failed_at = first + consumed
+            consumed = len(self._tokens)
+        self._tokens = self._tokens[consumed:]
+        for name, values in self._values.items():
+            self._values[name] = values[consumed:]
+
+
+def _combine(
+    values: np.ndarray, begins: np.ndarray, ends: np.ndarray, combine: str
+) -> np.ndarray:
+    # the values of the tokens begins[i]:ends[i], combined; 0 for no tokens
+    if combine == "sum":
+        # np.add.reduceat does not give zeros for empty ranges
+        cumsum = np.zeros(len(values) + 1, dtype=values.dtype)
+        np.cumsum(values, out=cumsum[1:])
+        return cumsum[ends] - cumsum[begins]
+    result = np.zeros(len(ends), dtype=values.dtype)
+    nonempty = ends > begins
+    if nonempty.any():
+        if combine == "max":
+            # the nonempty ranges are contiguous, so each ends where the next
+            # begins
+            result[nonempty] = np.maximum.reduceat(values[: ends[-1]], begins[nonempty])
+        else:
+            result[nonempty] = values[ends[nonempty] - 1]
+    return result
+
+
+def _align_prefix(
+    tokens: list[str], surfaces: list[str], valid: np.ndarray
+) -> tuple[np.ndarray, int, bool]:
+    # the end token of each of the leading surface words that the tokens
+    # align with, and whether the next word may still align with more tokens
+    token_ends = np.zeros(len(tokens) + 1, dtype=np.int64)
+    np.cumsum([len(token) for token in tokens], out=token_ends[1:])
+    surface_ends = np.cumsum([len(surface) for surface in surfaces], dtype=np.int64)
+
+    # the first token boundary at or after the end of each surface word
+    ends = np.searchsorted(token_ends, surface_ends)
+    on_boundary = ends < len(token_ends)
+    on_boundary[on_boundary] = (
+        token_ends[ends[on_boundary]] == surface_ends[on_boundary]
+    )
+
+    # surface words before the first differing character have the same text
+    def _codepoints(text: str) -> np.ndarray:
+        return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+
+    token_text = _codepoints("".join(tokens))
+    surface_text = _codepoints("".join(surfaces))
+    n = min(len(token_text), len(surface_text))
+    differ = np.flatnonzero(token_text[:n] != surface_text[:n])
+    same_until = differ[0] if len(differ) else n
+
+    aligned = valid & on_boundary & (surface_ends <= same_until)
+    n_aligned = len(surfaces) if aligned.all() else int(np.argmin(aligned))
+    incomplete = (
+        n_aligned < len(surfaces)
+        and bool(valid[n_aligned])
+        and surface_ends[n_aligned] > len(token_text)
+        and same_until == len(token_text)
+    )
+    return ends[:n_aligned], n_aligned, incomplete
 
 
 def clasify_combs(comb: str) -> str:
@@ -0,0 +1,277 @@
+"""
+Column-wise trees for corpus-scale processing.
+
+A FlatTree keeps the nodes of a tree in postorder as NumPy arrays:
+
+    cat    category id of each node (Category.from_id)
+    comb   combinator code of each node (COMB_LABELS)
+    start  position of the first node of each node's subtree, so node i spans
+           start[i]..i, its last child is i - 1 and the child before that is
+           start[i - 1] - 1
+    token  index of each leaf into `tokens`, -1 for internal nodes
+
+A FlatCorpus concatenates the columns of many trees, so that corpus-wide
+traversals can run as array operations. Category ids and combinator codes are
+only valid within the process; `FlatCorpus.to_arrays` adds the tables of
+their strings for storing the columns (see treecache.py).
+"""
+
+from bisect import bisect_left
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from category import Category
+from tree import Tree
+
+# combinator labels by code
+COMB_LABELS: list[str] = []
+COMB_CODES: dict[str, int] = {}
+
+
+def comb_code(label: str) -> int:
+    code = COMB_CODES.get(label)
+    if code is None:
+        code = COMB_CODES[label] = len(COMB_LABELS)
+        COMB_LABELS.append(label)
+    return code
+
+
+class FlatTree:
+    __slots__ = ("cat", "comb", "start", "token", "tokens")
+
+    def __init__(
+        self,
+        cat: np.ndarray,
+        comb: np.ndarray,
+        start: np.ndarray,
+        token: np.ndarray,
+        tokens: list[str],
+    ) -> None:
+        self.cat: np.ndarray = cat
+        self.comb: np.ndarray = comb
+        self.start: np.ndarray = start
+        self.token: np.ndarray = token
+        self.tokens: list[str] = tokens
+
+    @classmethod
+    def from_tree(cls, tree: Tree) -> "FlatTree":
+        cats: list[int] = []
+        combs: list[int] = []
+        starts: list[int] = []
+        token_ids: list[int] = []
+        tokens: list[str] = []
+
+        # iterative postorder; the subtree of a node starts where the node was
+        # first reached
+        stack: list[tuple[Tree, int]] = [(tree, -1)]
+        while stack:
+            node, start = stack.pop()
+            if node.children and start < 0:
+                stack.append((node, len(cats)))
+                stack.extend((child, -1) for child in reversed(node.children))
+                continue
+            cats.append(node.cat.id)
+            combs.append(comb_code(node.comb))
+            if node.is_terminal:
+                starts.append(len(starts))
+                token_ids.append(len(tokens))
+                tokens.append(node.token)
+            else:
+                starts.append(start)
+                token_ids.append(-1)
+
+        return cls(
+            np.array(cats, dtype=np.int32),
+            np.array(combs, dtype=np.int16),
+            np.array(starts, dtype=np.int32),
+            np.array(token_ids, dtype=np.int32),
+            tokens,
+        )
+
+    def to_tree(self) -> Tree:
+        # the completed subtrees that are not children yet, and where they
+        # start; the starts increase, so the children of a node are those
+        # from the first that starts inside its subtree
+        nodes: list[Tree] = []
+        starts: list[int] = []
+        for cat, comb, start, token in zip(
+            self.cat.tolist(),
+            self.comb.tolist(),
+            self.start.tolist(),
+            self.token.tolist(),
+        ):
+            if token >= 0:
+                node = Tree(
+                    Category.from_id(cat), None, COMB_LABELS[comb], self.tokens[token]
+                )
+            else:
+                n = bisect_left(starts, start)
+                node = Tree(Category.from_id(cat), nodes[n:], COMB_LABELS[comb])
+                del nodes[n:], starts[n:]
+            nodes.append(node)
+            starts.append(start)
+        assert len(nodes) == 1, "broken flat tree"
+        return nodes[0]
+
+    def __len__(self) -> int:
+        return len(self.cat)
+
+    @property
+    def root(self) -> int:
+        return len(self.cat) - 1
+
+    def category(self, i: int) -> Category:
+        return Category.from_id(int(self.cat[i]))
+
+    def label(self, i: int) -> str:
+        return COMB_LABELS[self.comb[i]]
+
+    def children(self, i: int) -> list[int]:
+        result: list[int] = []
+        child = i - 1
+        while child >= self.start[i]:
+            result.append(child)
+            child = self.start[child] - 1
+        return result[::-1]
+
+    @property
+    def is_terminal(self) -> np.ndarray:
+        return self.token >= 0
+
+    @property
+    def leaves(self) -> np.ndarray:
+        # node indices of the leaves, left to right
+        return np.flatnonzero(self.token >= 0)
+
+    @property
+    def terminal_cat(self) -> list[str]:
+        return [str(Category.from_id(cat)) for cat in self.cat[self.leaves].tolist()]
+
+    @property
+    def terminal_token_cat(self) -> list[tuple[str, Category]]:
+        cats = self.cat[self.leaves].tolist()
+        return [(token, Category.from_id(cat)) for token, cat in zip(self.tokens, cats)]
+
+    @property
+    def word(self) -> str:
+        return " ".join(self.tokens)
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.cat.nbytes + self.comb.nbytes + self.start.nbytes + self.token.nbytes
+        )
+
+
+class FlatCorpus:
+    """
+    The columns of many FlatTrees, concatenated. `start` and `token` stay
+    relative to their own tree, so trees are sliced out without copying;
+    `offsets` and `token_offsets` give where each tree begins.
+    """
+
+    def __init__(self, flat_trees: Iterable[FlatTree]) -> None:
+        flat_trees = list(flat_trees)
+        self.offsets: np.ndarray = np.cumsum(
+            [0] + [len(flat) for flat in flat_trees], dtype=np.int64
+        )
+        self.token_offsets: np.ndarray = np.cumsum(
+            [0] + [len(flat.tokens) for flat in flat_trees], dtype=np.int64
+        )
+
+        def _concat(column: str, dtype) -> np.ndarray:
+            if not flat_trees:
+                return np.zeros(0, dtype=dtype)
+            return np.concatenate([getattr(flat, column) for flat in flat_trees])
+
+        self.cat: np.ndarray = _concat("cat", np.int32)
+        self.comb: np.ndarray = _concat("comb", np.int16)
+        self.start: np.ndarray = _concat("start", np.int32)
+        self.token: np.ndarray = _concat("token", np.int32)
+        self.tokens: list[str] = [token for flat in flat_trees for token in flat.tokens]
+
+    @classmethod
+    def from_trees(cls, trees: Iterable[Tree]) -> "FlatCorpus":
+        return cls(FlatTree.from_tree(tree) for tree in trees)
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        # the columns, with categories and combinators as indices into tables
+        # of their strings
+        cat_ids, cat = np.unique(self.cat, return_inverse=True)
+        comb_codes, comb = np.unique(self.comb, return_inverse=True)
+        return {
+            "cat": cat.astype(np.int32),
+            "comb": comb.astype(np.int16),
+            "start": self.start,
+            "token": self.token,
+            "offsets": self.offsets,
+            "token_offsets": self.token_offsets,
+            "cat_table": np.array(
+                [str(Category.from_id(i)) for i in cat_ids.tolist()], dtype=str
+            ),
+            "comb_table": np.array(
+                [COMB_LABELS[code] for code in comb_codes.tolist()], dtype=str
+            ),
+            "tokens": np.array(self.tokens, dtype=str),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray]) -> "FlatCorpus":
+        cat_ids = np.array(
+            [Category.from_string(cat).id for cat in arrays["cat_table"].tolist()],
+            dtype=np.int32,
+        )
+        comb_codes = np.array(
+            [comb_code(label) for label in arrays["comb_table"].tolist()],
+            dtype=np.int16,
+        )
+        corpus = cls([])
+        corpus.cat = cat_ids[arrays["cat"]]
+        corpus.comb = comb_codes[arrays["comb"]]
+        corpus.start = arrays["start"]
+        corpus.token = arrays["token"]
+        corpus.offsets = arrays["offsets"]
+        corpus.token_offsets = arrays["token_offsets"]
+        corpus.tokens = arrays["tokens"].tolist()
+        return corpus
+
+    def to_trees(self) -> Iterator[Tree]:
+        for flat in self:
+            yield flat.to_tree()
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> FlatTree:
+        if i < 0:
+            i += len(self)
+        begin, end = self.offsets[i], self.offsets[i + 1]
+        token_begin, token_end = self.token_offsets[i], self.token_offsets[i + 1]
+        return FlatTree(
+            self.cat[begin:end],
+            self.comb[begin:end],
+            self.start[begin:end],
+            self.token[begin:end],
+            self.tokens[token_begin:token_end],
+        )
+
+    def __iter__(self) -> Iterator[FlatTree]:
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def tree_ids(self) -> np.ndarray:
+        # the tree each node belongs to
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    @property
+    def absolute_start(self) -> np.ndarray:
+        return self.start + self.offsets[self.tree_ids]
+
+    @property
+    def absolute_token(self) -> np.ndarray:
+        # index of each leaf into the corpus-wide `tokens`, -1 for internal nodes
+        return np.where(
+            self.token >= 0, self.token + self.token_offsets[self.tree_ids], -1
+        )
@@ -0,0 +1,362 @@
+"""
+Packed forests of the derivations of a sentence.
+
+A Forest is a CKY chart over the lexical categories of a Tree, filled with
+every rule of grammar.COMBINATORS, and pruned to the derivations that reach
+the category of the tree's root. The derivations share their nodes, so
+statistics over all of them are computed by dynamic programming over the nodes
+instead of by enumerating the derivations:
+
+    forest = Forest(tree)
+    forest.num_derivations
+    expected, low, high = forest.word_counts("Comp")
+
+A combinator is counted for the last word of the constituent that it builds,
+as CompositionCount counts the nodes of a single tree.
+
+Categories are taken without features, as the rules of grammar.py ignore them.
+Besides COMBINATORS, the chart takes the steps of the tree that COMBINATORS
+does not: its unary type changes, and the binary rules that the readers add for
+coordination and for unknown combinations ("TC2", "glue"). Like rotate2left,
+which does not rotate through them, these steps keep their spans: they apply
+to the same words as in the tree, and no node of the chart crosses them. With
+`punctuation`, the attachment of punctuation marks is kept as well.
+
+Nodes are keyed by (begin, end, category id, tag). The tag records what built
+the node where later rules depend on it: ">B" and "<B" for the results of
+harmonic and crossed compositions, which Eisner's normal form keeps out of the
+functor position of further rules in the same direction, and "U" per unary rule
+in a chain of unary type changes.
+"""
+
+from typing import Iterator, Optional
+
+import numpy as np
+
+from category import Category
+from count import clasify_combs
+from grammar import all_binary_comps
+from tree import Tree
+
+Key = tuple[int, int, int, str]
+# (combinator, children)
+Edge = tuple[str, tuple[Key, ...]]
+Rule = tuple[Category, str]
+
+
+def _add_rule(rules: list[Rule], rule: Rule) -> None:
+    # once per (category id, combinator), as in all_binary_comps
+    if all(rule[0] is not cat or rule[1] != comb for cat, comb in rules):
+        rules.append(rule)
+
+
+class _TreeSteps:
+    """
+    The steps of a tree that the chart keeps: its unary type changes, which
+    apply to the same spans as in the tree, the binary steps that COMBINATORS
+    does not take with the same category and combinator, and the spans that
+    no node of the chart may cross.
+    """
+
+    __slots__ = ("unary", "chains", "binary", "brackets")
+
+    def __init__(self, tree: Tree, punctuation: bool) -> None:
+        # (begin, end, child id) -> rules; (begin, end) -> longest unary chain
+        self.unary: dict[tuple[int, int, int], list[Rule]] = {}
+        self.chains: dict[tuple[int, int], int] = {}
+        # (left id, right id) -> rules
+        self.binary: dict[tuple[int, int], list[Rule]] = {}
+        self.brackets: list[tuple[int, int]] = []
+
+        offset = tree.span[0]
+        stack = [(tree, 0)]
+        while stack:
+            node, chain = stack.pop()
+            if not node.children:
+                continue
+            i, j = node.span
+            i, j = i - offset, j - offset
+            cat = node.cat.without_feature
+            children = [child.cat.without_feature for child in node.children]
+            if len(children) == 1:
+                _add_rule(
+                    self.unary.setdefault((i, j, children[0].id), []), (cat, node.comb)
+                )
+                self.chains[(i, j)] = max(self.chains.get((i, j), 0), chain + 1)
+                self.brackets.append((i, j))
+                stack.append((node.children[0], chain + 1))
+                continue
+            stack.extend((child, 0) for child in node.children)
+            # the tree's own step, unless the grammar takes the same one
+            derived = all_binary_comps(*children)
+            if not any(
+                result is cat and label == node.comb for result, label in derived
+            ):
+                key = (children[0].id, children[1].id)
+                _add_rule(self.binary.setdefault(key, []), (cat, node.comb))
+            elif not (punctuation and node.comb == "punc"):
+                continue
+            self.brackets.append((i, j))
+            self.brackets.extend(
+                (child.span[0] - offset, child.span[1] - offset)
+                for child in node.children
+            )
+
+    def crossing(self, n: int) -> np.ndarray:
+        # crossing[i, j]: whether words i..j-1 cross a bracket
+        crossing = np.zeros((n + 1, n + 1), dtype=bool)
+        for begin, end in set(self.brackets):
+            crossing[:begin, begin + 1 : end] = True
+            crossing[begin + 1 : end, end + 1 :] = True
+        return crossing
+
+
+def _tag(label: str) -> str:
+    if label.startswith(">B"):
+        return ">B"
+    if label.startswith("<B"):
+        return "<B"
+    return ""
+
+
+def _normal_form(label: str, left_tag: str, right_tag: str) -> bool:
+    # Eisner (1996): the result of a forward composition is not the functor of
+    # a forward application or composition, and likewise backwards
+    if left_tag == ">B" and (label == ">" or label.startswith(">B")):
+        return False
+    if right_tag == "<B" and (label == "<" or label.startswith("<B")):
+        return False
+    return True
+
+
+class Forest:
+    """
+    All the derivations over the lexical categories of `tree` whose root has
+    the category of `tree`'s root, as a packed forest. `nodes` maps each node
+    that takes part in such a derivation to the ways it is built, children
+    before parents in `order`; leaves are built by "lex" with no children.
+    """
+
+    __slots__ = ("tokens", "cats", "nodes", "roots", "order", "_inside")
+
+    def __init__(
+        self,
+        tree: Tree,
+        normal_form: bool = True,
+        punctuation: bool = False,
+    ) -> None:
+        leaves = tree.terminal_token_cat
+        self.tokens: list[str] = [token for token, _ in leaves]
+        self.cats: list[Category] = [cat.without_feature for _, cat in leaves]
+        n = len(leaves)
+
+        steps = _TreeSteps(tree, punctuation)
+        crossing = steps.crossing(n)
+        binary: dict[tuple[int, int], list[Rule]] = {}
+
+        def _binary(left_id: int, right_id: int) -> list[Rule]:
+            rules = binary.get((left_id, right_id))
+            if rules is None:
+                rules = binary[(left_id, right_id)] = list(
+                    all_binary_comps(
+                        Category.from_id(left_id), Category.from_id(right_id)
+                    )
+                )
+                # the tree's steps for the pair differ from the results of
+                # all_binary_comps in category or combinator
+                rules.extend(steps.binary.get((left_id, right_id), ()))
+            return rules
+
+        # chart[i][j]: the nodes spanning words i..j-1 and their edges;
+        # tags[i][j]: the tags of each category of chart[i][j]
+        chart: list[list[dict[tuple[int, str], list[Edge]]]] = [
+            [{} for _ in range(n + 1)] for _ in range(n)
+        ]
+        tags: list[list[dict[int, list[str]]]] = [
+            [{} for _ in range(n + 1)] for _ in range(n)
+        ]
+
+        def _close(i: int, j: int) -> None:
+            # add the unary rules of the span to the nodes of a cell
+            cell = chart[i][j]
+            chain = steps.chains.get((i, j), 0)
+            agenda = list(cell)
+            while agenda:
+                cat_id, tag = agenda.pop()
+                depth = tag.count("U")
+                if depth >= chain:
+                    continue
+                for parent, comb in steps.unary.get((i, j, cat_id), ()):
+                    key = (parent.id, "U" * (depth + 1))
+                    if key not in cell:
+                        cell[key] = []
+                        agenda.append(key)
+                    cell[key].append((comb, ((i, j, cat_id, tag),)))
+            for cat_id, tag in cell:
+                tags[i][j].setdefault(cat_id, []).append(tag)
+
+        for i, cat in enumerate(self.cats):
+            chart[i][i + 1][(cat.id, "")] = [("lex", ())]
+            _close(i, i + 1)
+
+        for length in range(2, n + 1):
+            for i in range(n - length + 1):
+                j = i + length
+                if crossing[i, j]:
+                    continue
+                cell = chart[i][j]
+                for k in range(i + 1, j):
+                    right_tags = tags[k][j]
+                    for left_id, left_tags in tags[i][k].items():
+                        for right_id in right_tags:
+                            for cat, label in _binary(left_id, right_id):
+                                edges = cell.setdefault((cat.id, _tag(label)), [])
+                                for left_tag in left_tags:
+                                    for right_tag in right_tags[right_id]:
+                                        if normal_form and not _normal_form(
+                                            label, left_tag, right_tag
+                                        ):
+                                            continue
+                                        children = (
+                                            (i, k, left_id, left_tag),
+                                            (k, j, right_id, right_tag),
+                                        )
+                                        edges.append((label, children))
+                # normal form may leave a node without edges
+                for key in [key for key, edges in cell.items() if not edges]:
+                    del cell[key]
+                _close(i, j)
+
+        root_id = tree.cat.without_feature.id
+        self.roots: list[Key] = []
+        if n:
+            self.roots = [
+                (0, n, cat_id, tag) for cat_id, tag in chart[0][n] if cat_id == root_id
+            ]
+
+        # keep what the roots reach, children before their parents
+        self.nodes: dict[Key, list[Edge]] = {}
+        self.order: list[Key] = []
+        tasks: list[tuple[Key, bool]] = [(root, False) for root in self.roots]
+        while tasks:
+            key, visited = tasks.pop()
+            if visited:
+                self.order.append(key)
+                continue
+            if key in self.nodes:
+                continue
+            i, j, cat_id, tag = key
+            edges = self.nodes[key] = chart[i][j][(cat_id, tag)]
+            tasks.append((key, True))
+            for _, children in edges:
+                tasks.extend((child, False) for child in children)
+        self._inside: Optional[dict[Key, int]] = None
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def num_edges(self) -> int:
+        return sum(len(edges) for edges in self.nodes.values())
+
+    def edges(self) -> Iterator[tuple[Key, str, tuple[Key, ...]]]:
+        for key in self.order:
+            for label, children in self.nodes[key]:
+                yield key, label, children
+
+    @property
+    def inside(self) -> dict[Key, int]:
+        # the number of derivations of each node
+        if self._inside is None:
+            inside: dict[Key, int] = {}
+            for key in self.order:
+                total = 0
+                for _, children in self.nodes[key]:
+                    product = 1
+                    for child in children:
+                        product *= inside[child]
+                    total += product
+                inside[key] = total
+            self._inside = inside
+        return self._inside
+
+    @property
+    def num_derivations(self) -> int:
+        inside = self.inside
+        return sum(inside[root] for root in self.roots)
+
+    def outside(self) -> dict[Key, int]:
+        # the number of ways to complete a derivation of each node to a root
+        inside = self.inside
+        outside: dict[Key, int] = dict.fromkeys(self.nodes, 0)
+        for root in self.roots:
+            outside[root] = 1
+        for key in reversed(self.order):
+            above = outside[key]
+            for _, children in self.nodes[key]:
+                # edges have at most two children
+                if len(children) == 2:
+                    left, right = children
+                    outside[left] += above * inside[right]
+                    outside[right] += above * inside[left]
+                elif children:
+                    outside[children[0]] += above
+        return outside
+
+    def word_counts(
+        self, kind: str = "Comp"
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The number of combinators of class `kind` (see count.clasify_combs)
+        per word: its expectation when all the derivations are equally likely,
+        and its minimum and maximum over the derivations. NaN when no
+        derivation reaches the root category.
+        """
+        n = len(self.tokens)
+        if not self.roots:
+            return np.full(n, np.nan), np.full(n, np.nan), np.full(n, np.nan)
+        counted = {label: clasify_combs(label) == kind for _, label, _ in self.edges()}
+
+        # an edge takes part in outside(node) * prod(inside(children))
+        # derivations
+        inside, outside = self.inside, self.outside()
+        weights = [0] * n
+        for key, label, children in self.edges():
+            if counted[label]:
+                product = outside[key]
+                for child in children:
+                    product *= inside[child]
+                weights[key[1] - 1] += product
+        total = self.num_derivations
+        expected = np.array([weight / total for weight in weights])
+
+        # the counts of a word add up over the children of an edge, so their
+        # minimum and maximum over the derivations of a node are the minimum
+        # and maximum over its edges. bounds[key]: the minimum and maximum
+        # counts of the words that the node spans
+        bounds: dict[Key, np.ndarray] = {}
+        for key in self.order:
+            edge_bounds = []
+            for label, children in self.nodes[key]:
+                if not children:
+                    edge = np.zeros((2, 1), dtype=np.int64)
+                elif len(children) == 1:
+                    edge = bounds[children[0]].copy()
+                else:
+                    edge = np.concatenate([bounds[child] for child in children], 1)
+                if counted[label]:
+                    edge[:, -1] += 1
+                edge_bounds.append(edge)
+            if len(edge_bounds) == 1:
+                bounds[key] = edge_bounds[0]
+            else:
+                edge_bounds = np.stack(edge_bounds)
+                bounds[key] = np.stack(
+                    [edge_bounds[:, 0].min(0), edge_bounds[:, 1].max(0)]
+                )
+        roots = np.stack([bounds[root] for root in self.roots])
+        return (
+            expected,
+            roots[:, 0].min(0).astype(float),
+            roots[:, 1].max(0).astype(float),
+        )
@@ -1,4 +1,5 @@
-import copy
+import hashlib
+import time
 from typing import Optional
 
 from category import Category, Complex
@@ -16,212 +17,73 @@ CONJ: Category = Category.from_string("conj")
 
 def fa(left: Category, right: Category) -> Optional[Category]:
     if left.is_complex and left.right == right and left.slash == "/":
-        left_deepcopy = copy.deepcopy(left)
-        return left_deepcopy.left
+        return left.left
     return
 
 
 def ba(left: Category, right: Category) -> Optional[Category]:
     if right.is_complex and left == right.right and right.slash == "\\":
-        right_deepcopy = copy.deepcopy(right)
-        return right_deepcopy.left
+        return right.left
     return
 
 
-def fc(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.is_complex
-        and right.is_complex
-        and left.right == right.left
-        and left.slash == right.slash == "/"
-    ):
-        return Complex(
-            left.left,
-            "/",
-            right.right,
-        )
-    return
-
-
-def fc2(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.is_complex
-        and right.nargs >= 2
-        and left.right == right.left.left
-        and left.slash == right.left.slash == "/"
-    ):
-        result = copy.deepcopy(right)
-        result.left.left = left.left
-        return result
-    return
-
-
-def fc3(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.is_complex
-        and right.nargs >= 3
-        and left.right == right.left.left.left
-        and left.slash == right.left.left.slash == "/"
-    ):
-        result = copy.deepcopy(right)
-        result.left.left.left = left.left
-        return result
-    return
-
-
-def fc4(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.is_complex
-        and right.nargs >= 4
-        and left.right == right.left.left.left.left
-        and left.slash == right.left.left.left.slash == "/"
-    ):
-        result = copy.deepcopy(right)
-        result.left.left.left.left = left.left
-        return result
-    return
-
-
-def fcx(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.is_complex
-        and right.is_complex
-        and left.right == right.left
-        and left.slash == "/"
-        and right.slash == "\\"
-    ):
-        return Complex(
-            left.left,
-            "\\",
-            right.right,
-        )
-    return
-
-
-def fc2x(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.is_complex
-        and right.nargs >= 2
-        and left.right == right.left.left
-        and left.slash == "/"
-        and right.left.slash == "\\"
-    ):
-        result = copy.deepcopy(right)
-        result.left.left = left.left
-        return result
-    return
-
-
-def fc3x(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.is_complex
-        and right.nargs >= 3
-        and left.right == right.left.left.left
-        and left.slash == "/"
-        and right.left.left.slash == "\\"
-    ):
-        result = copy.deepcopy(right)
-        result.left.left.left = left.left
-        return result
-    return
-
-
-def fc4x(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.is_complex
-        and right.nargs >= 4
-        and left.right == right.left.left.left.left
-        and left.slash == "/"
-        and right.left.left.left.slash == "\\"
-    ):
-        result = copy.deepcopy(right)
-        result.left.left.left.left = left.left
-        return result
-    return
-
-
-def bc(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.is_complex
-        and right.is_complex
-        and left.left == right.right
-        and right.slash == left.slash == "\\"
-    ):
-        return Complex(
-            right.left,
-            "\\",
-            left.right,
-        )
-    return
-
-
-def bc2(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.nargs >= 2
-        and right.is_complex
-        and left.left.left == right.right
-        and right.slash == left.left.slash == "\\"
-    ):
-        result = copy.deepcopy(left)
-        result.left.left = right.left
-        return result
-    return
+# maximum degree of generalized composition, per direction
+MAX_DEGREE: dict[str, int] = {">": 4, "<": 3}
 
 
-def bc3(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.nargs >= 3
-        and right.is_complex
-        and left.left.left.left == right.right
-        and right.slash == left.left.left.slash == "\\"
-    ):
-        result = copy.deepcopy(left)
-        result.left.left.left = right.left
-        return result
-    return
+def composition_label(direction: str, crossed: bool, degree: int) -> str:
+    if direction == ">":
+        if crossed:
+            return f">Bx{degree}"
+        return ">B" if degree == 1 else f">B{degree}"
+    if crossed:
+        return "<Bx" if degree == 1 else f"<Bx{degree}"
+    return f"<B{degree}"
 
 
-def bcx(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.is_complex
-        and right.is_complex
-        and left.left == right.right
-        and right.slash == "\\"
-        and left.slash == "/"
-    ):
-        return Complex(
-            right.left,
-            "/",
-            left.right,
-        )
-    return
+def _compose(functor: Category, result: Category, degree: int) -> Category:
+    if degree == 1:
+        return Complex(result, functor.slash, functor.right)
+    return functor.with_result(result, degree)
 
 
-def bc2x(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.nargs >= 2
-        and right.is_complex
-        and left.left.left == right.right
-        and right.slash == "\\"
-        and left.left.slash == "/"
-    ):
-        result = copy.deepcopy(left)
-        result.left.left = right.left
-        return result
+def forward_composition(
+    left: Category, right: Category
+) -> Optional[tuple[Category, str]]:
+    # X/Y (..(Y|Z1)..)|Zn => (..(X|Z1)..)|Zn; harmonic (|1 = /) before crossed
+    if not left.is_complex or left.slash != "/":
+        return
+    crossed: Optional[int] = None
+    degree = min(right.nargs, MAX_DEGREE[">"])
+    for n, functor in enumerate(right.spine[:degree], 1):
+        if functor.left == left.right:
+            if functor.slash == "/":
+                return _compose(right, left.left, n), composition_label(">", False, n)
+            elif crossed is None:
+                crossed = n
+    if crossed:
+        label = composition_label(">", True, crossed)
+        return _compose(right, left.left, crossed), label
     return
 
 
-def bc3x(left: Category, right: Category) -> Optional[Category]:
-    if (
-        left.nargs >= 3
-        and right.is_complex
-        and left.left.left.left == right.right
-        and right.slash == "\\"
-        and left.left.left.slash == "/"
-    ):
-        result = copy.deepcopy(left)
-        result.left.left.left = right.left
-        return result
+def backward_composition(
+    left: Category, right: Category
+) -> Optional[tuple[Category, str]]:
+    # (..(Y|Z1)..)|Zn X\Y => (..(X|Z1)..)|Zn; harmonic (|1 = \) before crossed
+    if not right.is_complex or right.slash != "\\":
+        return
+    crossed: Optional[int] = None
+    degree = min(left.nargs, MAX_DEGREE["<"])
+    for n, functor in enumerate(left.spine[:degree], 1):
+        if functor.left == right.right:
+            if functor.slash == "\\":
+                return _compose(left, right.left, n), composition_label("<", False, n)
+            elif crossed is None:
+                crossed = n
+    if crossed:
+        label = composition_label("<", True, crossed)
+        return _compose(left, right.left, crossed), label
     return
 
 
@@ -238,35 +100,254 @@ def conj(left: Category, right: Category) -> Optional[Category]:
         return right
 
 
+# rules in priority order with their labels; composition rules report their
+# own label (">B2", "<Bx3", ...) along with the result
 COMBINATORS: dict = {
     fa: ">",
     ba: "<",
-    fc: ">B",
-    fc2: ">B2",
-    fc3: ">B3",
-    fc4: ">B4",
-    fcx: ">Bx1",
-    fc2x: ">Bx2",
-    fc3x: ">Bx3",
-    fc4x: ">Bx4",
-    bc: "<B1",
-    bc2: "<B2",
-    bc3: "<B3",
-    bcx: "<Bx",
-    bc2x: "<Bx2",
-    bc3x: "<Bx3",
+    forward_composition: None,
+    backward_composition: None,
     punc: "punc",
     conj: ">",  # corresponds to conj
 }
 
+# the shape a category pair needs for a rule to apply:
+# (left slash, minimum left nargs, right slash, minimum right nargs)
+SHAPES: dict = {
+    fa: ("/", 1, None, 0),
+    ba: (None, 0, "\\", 1),
+    forward_composition: ("/", 1, None, 1),
+    backward_composition: (None, 1, "\\", 1),
+    punc: (None, 0, None, 0),
+    conj: (None, 0, None, 0),
+}
 
-def binary_comp(
+# (left, right) -> (result, label), keyed on the category strings
+COMP_TABLE: dict[tuple[str, str], tuple[Optional[Category], Optional[str]]] = {}
+COMP_STATS: dict[str, int] = {"hits": 0, "misses": 0}
+RULE_CALLS: dict[str, int] = {}
+RULE_TIME: dict[str, float] = {}
+
+# candidate rules per shape of (left, right), in the priority order of COMBINATORS
+_DISPATCH: dict[tuple, list] = {}
+_MAX_NARGS: int = max(max(shape[1], shape[3]) for shape in SHAPES.values())
+
+
+def _shape(cat: Category) -> tuple[Optional[str], int]:
+    return (cat.slash if cat.is_complex else None), min(cat.nargs, _MAX_NARGS)
+
+
+def _candidates(left: Category, right: Category) -> list:
+    key = _shape(left) + _shape(right)
+    candidates = _DISPATCH.get(key)
+    if candidates is None:
+        left_slash, left_nargs, right_slash, right_nargs = key
+        candidates = [
+            combinator
+            for combinator in COMBINATORS
+            if (SHAPES[combinator][0] in (None, left_slash))
+            and left_nargs >= SHAPES[combinator][1]
+            and (SHAPES[combinator][2] in (None, right_slash))
+            and right_nargs >= SHAPES[combinator][3]
+        ]
+        _DISPATCH[key] = candidates
+    return candidates
+
+
+def _binary_comp(
     left: Category, right: Category
 ) -> tuple[Optional[Category], Optional[str]]:
-    for combinator in COMBINATORS:
-        cat: Optional[Category] = combinator(left, right)
-        if cat:
-            return cat, COMBINATORS[combinator]
-        else:
-            continue
+    for combinator in _candidates(left, right):
+        start = time.perf_counter()
+        result = combinator(left, right)
+        name = combinator.__name__
+        RULE_TIME[name] = RULE_TIME.get(name, 0.0) + time.perf_counter() - start
+        RULE_CALLS[name] = RULE_CALLS.get(name, 0) + 1
+        if result:
+            label = COMBINATORS[combinator]
+            return (result, label) if label else result
     return None, None
+
+
+def binary_comp(
+    left: Category, right: Category
+) -> tuple[Optional[Category], Optional[str]]:
+    key = (str(left), str(right))
+    result = COMP_TABLE.get(key)
+    if result is not None:
+        COMP_STATS["hits"] += 1
+        return result
+    COMP_STATS["misses"] += 1
+    result = COMP_TABLE[key] = _binary_comp(left, right)
+    return result
+
+
+# (left, right) -> every (result, label) that some rule gives, in priority order
+ALL_COMP_TABLE: dict[tuple[str, str], tuple[tuple[Category, str], ...]] = {}
+
+
+def all_binary_comps(
+    left: Category, right: Category
+) -> tuple[tuple[Category, str], ...]:
+    """
+    The results of all the rules of COMBINATORS that apply to (left, right);
+    binary_comp gives only the first of them.
+    """
+    key = (str(left), str(right))
+    results = ALL_COMP_TABLE.get(key)
+    if results is None:
+        found: dict[tuple[int, str], tuple[Category, str]] = {}
+        for combinator in _candidates(left, right):
+            result = combinator(left, right)
+            if not result:
+                continue
+            label = COMBINATORS[combinator]
+            cat, label = (result, label) if label else result
+            # results are told apart by id, since == ignores all features:
+            # results that only differ in features are kept, and a category
+            # that two rules with the same label derive (fa and conj, both
+            # ">") is kept once
+            found.setdefault((cat.id, label), (cat, label))
+        results = ALL_COMP_TABLE[key] = tuple(found.values())
+    return results
+
+
+def set_max_degree(forward: Optional[int] = None, backward: Optional[int] = None):
+    if forward is not None:
+        MAX_DEGREE[">"] = forward
+    if backward is not None:
+        MAX_DEGREE["<"] = backward
+    # memoized results may depend on the old limits
+    COMP_TABLE.clear()
+    ALL_COMP_TABLE.clear()
+
+
+# unary type changes, keyed on the feature-free (parent, child) categories
+UNARY_RULES: dict[tuple[str, str], str] = {}
+
+
+# the same for the Japanese CCGBank, whose trees carry their own labels
+JA_UNARY_RULES: dict[tuple[str, str], str] = {}
+
+
+def register_unary_rule(
+    parent: str | Category,
+    child: str | Category,
+    comb: str,
+    rules: Optional[dict[tuple[str, str], str]] = None,
+) -> None:
+    if isinstance(parent, str):
+        parent = Category.from_string(parent)
+    if isinstance(child, str):
+        child = Category.from_string(child)
+    rules = UNARY_RULES if rules is None else rules
+    rules[(str(parent.without_feature), str(child.without_feature))] = comb
+
+
+def unary_comp(
+    parent: Category,
+    child: Category,
+    rules: Optional[dict[tuple[str, str], str]] = None,
+) -> Optional[str]:
+    rules = UNARY_RULES if rules is None else rules
+    return rules.get((str(parent.without_feature), str(child.without_feature)))
+
+
+def coordination(left: Category, right: Category, cat: Category) -> Optional[str]:
+    """
+    The label of the binary steps of AUTO derivations that AutoLineReader
+    takes before the rules of COMBINATORS: a conjunction and its conjunct
+    (">"), the coordination X X[conj] => X ("<"), punctuation before a
+    conjunct ("punc") and glue; None for the other nodes. `cat` is the
+    category of the node.
+    """
+    if left == CONJ:
+        return ">"
+    if "conj" not in right.features:
+        return
+    if left.without_feature == right.without_feature:
+        return "<"
+    if left in PUNC and right.without_feature == cat.without_feature:
+        return "punc"
+    if str(cat) == "GLUE":
+        return "glue"
+    return
+
+
+def grammar_fingerprint() -> str:
+    # the settings that derivations read with this grammar depend on
+    settings = (
+        sorted(MAX_DEGREE.items()),
+        sorted(UNARY_RULES.items()),
+        sorted(JA_UNARY_RULES.items()),
+    )
+    return hashlib.sha256(repr(settings).encode()).hexdigest()
+
+
+for parent, child, comb in [
+    ("NP", "N", "NM"),
+    ("S/(S\\NP)", "NP", ">T"),
+    ("NP\\NP", "S\\NP", "ADN"),
+    ("N\\N", "S\\NP", "ADN"),
+    ("(S\\NP)\\(S\\NP)", "S\\NP", "ADV"),
+    ("S\\NP", "NP", "TC"),
+    ("S\\NP", "N", "TC"),
+    ("S\\NP", "S/(S/NP)", "TC"),
+    ("S\\NP", "NP\\NP", "TC"),
+    ("S\\NP", "N\\N", "TC"),
+    ("S\\NP", "S/(S\\NP)", "TC"),
+    ("S\\NP", "(S\\NP)\\(S\\NP)", "TC"),
+    ("NP", "(S\\NP)\\(S\\NP)", "TC"),
+    ("N", "(S\\NP)\\(S\\NP)", "TC"),
+    ("S/NP", "N\\N", "TC"),
+]:
+    register_unary_rule(parent, child, comb)
+
+for parent, child, comb in [
+    ("NP/NP", "S", "ADNint"),
+    ("NP/NP", "S\\NP", "ADNint"),
+    ("S/S", "S", "ADV0"),
+    ("S/S", "NP", "ADV0"),
+    ("(S\\NP)/(S\\NP)", "S\\NP", "ADV0"),
+]:
+    register_unary_rule(parent, child, comb, JA_UNARY_RULES)
+
+
+def comp_stats() -> dict:
+    total = COMP_STATS["hits"] + COMP_STATS["misses"]
+    return {
+        **COMP_STATS,
+        "hit_rate": COMP_STATS["hits"] / total if total else 0.0,
+        "table_size": len(COMP_TABLE),
+        "rule_calls": dict(RULE_CALLS),
+        "rule_time": dict(RULE_TIME),
+    }
+
+
+def _comp_table_header() -> str:
+    # the results of composition depend on the degrees allowed
+    return f"# max_degree\t>{MAX_DEGREE['>']}\t<{MAX_DEGREE['<']}"
+
+
+def save_comp_table(filepath: str) -> None:
+    with open(filepath, "w") as f:
+        print(_comp_table_header(), file=f)
+        for (left, right), (cat, comb) in COMP_TABLE.items():
+            print(left, right, str(cat) if cat else "", comb or "", sep="\t", file=f)
+
+
+def load_comp_table(filepath: str) -> None:
+    # only tables saved with the current MAX_DEGREE are loaded
+    with open(filepath, "r") as f:
+        header = f.readline().rstrip("\n")
+        if header != _comp_table_header():
+            raise ValueError(
+                f"{filepath}: saved with other degree limits ({header!r}) "
+                f"than MAX_DEGREE {MAX_DEGREE}"
+            )
+        for line in f:
+            left, right, cat, comb = line.rstrip("\n").split("\t")
+            COMP_TABLE[(left, right)] = (
+                Category.from_string(cat) if cat else None,
+                comb or None,
+            )
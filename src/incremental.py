@@ -0,0 +1,137 @@
+"""
+Word-by-word simulation of the left-branching derivations.
+
+`simulate` runs a shift-reduce stack machine over a derivation, making the
+type-raising and rotation decisions of a Pipeline of passes.TypeRaise and
+passes.RotateLeft (EN_PREPROCESS or JA_PREPROCESS) with the same rules
+(TypeRaise.raised and passes.rotation), but on categories: neither the
+rotated tree nor any Tree node is built. The nodes that the rotations create
+are tuples that exist only while they are pending on the machine's stack.
+
+    for step in simulate(tree, EN_PREPROCESS):
+        step.token, step.combinators, step.stack_depth, step.pending
+
+The combinators of each word are those that CompositionCount counts for its
+token in EN_PREPROCESS.run(tree), and `stack_depth` is the "stack_depth"
+metric of count.py.
+"""
+
+from typing import Callable, Iterator, Optional, Union
+
+from category import Category
+from passes import Pipeline, RotateLeft, TypeRaise, rotation
+from tree import Tree
+
+# a node of the transformed derivation that does not exist as a Tree:
+# (category, combinator, children)
+Node = tuple[Category, str, tuple]
+Item = Union[Tree, Node]
+
+
+class WordStep:
+    """
+    One word of the incremental derivation: the word is shifted with its
+    lexical category, then the nodes that it completes are reduced with
+    `combinators`. `stack_depth` is the number of constituents on the stack
+    after that, and `pending` the number of arguments that their categories
+    are still waiting for.
+    """
+
+    __slots__ = ("token", "cat", "combinators", "stack_depth", "pending")
+
+    def __init__(self, token: str, cat: Category) -> None:
+        self.token: str = token
+        self.cat: Category = cat
+        self.combinators: list[str] = []
+        self.stack_depth: int = 0
+        self.pending: int = 0
+
+    def __repr__(self) -> str:
+        return (
+            f"WordStep({self.token!r}, {self.cat}, {self.combinators}, "
+            f"stack_depth={self.stack_depth}, pending={self.pending})"
+        )
+
+
+def _expand(
+    item: Item, raised: Optional[Callable[[str, Category, Category], Category]]
+) -> Node:
+    # the internal node as the rotation sees it, i.e. type-raised; created
+    # nodes are never raised again
+    if isinstance(item, tuple):
+        return item
+    if raised is not None and item.is_binary:
+        left, right = item.children
+        cat = raised(item.comb, left.cat, right.cat)
+        if cat is not None:
+            return item.cat, ">", ((cat, ">T", (left,)), right)
+    return item.cat, item.comb, tuple(item.children)
+
+
+def _cat(item: Item) -> Category:
+    return item[0] if isinstance(item, tuple) else item.cat
+
+
+def simulate(tree: Tree, pipeline: Optional[Pipeline] = None) -> Iterator[WordStep]:
+    """
+    The steps of the left-to-right derivation of `tree` as transformed by
+    `pipeline` (untransformed by default), one word at a time. The pipeline
+    can type-raise and then rotate, i.e. have a TypeRaise and then a
+    RotateLeft pass, or either of them.
+    """
+    raised = None
+    rotate = False
+    for p in pipeline.passes if pipeline is not None else ():
+        if isinstance(p, TypeRaise) and raised is None and not rotate:
+            raised = p.raised
+        elif isinstance(p, RotateLeft) and not rotate:
+            rotate = True
+        else:
+            raise ValueError(f"simulate cannot run {pipeline.name}")
+
+    stack: list[Category] = []
+    pending = 0
+    step: Optional[WordStep] = None
+    # (item, False) to visit, ((category, combinator, arity), True) to reduce
+    tasks: list[tuple] = [(tree, False)]
+    while tasks:
+        item, reduce = tasks.pop()
+        if reduce:
+            cat, comb, arity = item
+            for _ in range(arity):
+                pending -= stack.pop().nargs
+            stack.append(cat)
+            pending += cat.nargs
+            step.combinators.append(comb)
+            continue
+
+        if isinstance(item, Tree) and not item.children:
+            if step is not None:
+                step.stack_depth, step.pending = len(stack), pending
+                yield step
+            step = WordStep(item.token, item.cat)
+            stack.append(item.cat)
+            pending += item.cat.nargs
+            continue
+
+        cat, comb, children = _expand(item, raised)
+        while rotate and len(children) == 2:
+            left, right = children
+            if isinstance(right, Tree) and not right.children:
+                break
+            right_children = _expand(right, raised)[2]
+            if len(right_children) != 2:
+                break
+            middle, right = right_children
+            rotated = rotation(_cat(left), _cat(middle), _cat(right))
+            if rotated is None:
+                break
+            left_cat, left_comb, cat, comb = rotated
+            children = ((left_cat, left_comb, (left, middle)), right)
+
+        tasks.append(((cat, comb, len(children)), True))
+        tasks.extend((child, False) for child in reversed(children))
+
+    if step is not None:
+        step.stack_depth, step.pending = len(stack), pending
+        yield step
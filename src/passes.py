@@ -0,0 +1,204 @@
+"""
+Fused tree transforms.
+
+A Pass rewrites a single node; a Pipeline runs several passes in one
+traversal, as if each pass had been applied to the whole tree before the next
+one starts:
+
+    rotate2left(en_apply_typeraise(tree)) == EN_PREPROCESS.run(tree)
+
+Passes are applied lazily: a node is only rewritten by a pass when that pass,
+or a later one, looks at it. Subtrees that no pass changes are shared with the
+input tree instead of being copied, and `Pipeline.postorder` yields the final
+nodes without building the output tree at all. Since the output of an input
+subtree that no pass has looked at only depends on its structure, postorder
+can also leave such subtrees to the caller, e.g. to reuse cached columns (see
+count.NodeTable).
+"""
+
+from abc import ABC, abstractmethod
+from functools import partial
+from typing import Callable, Iterator, Optional
+
+from category import Category
+from grammar import binary_comp
+from tree import Tree, en_raisable, raisable, typeraise
+
+View = Callable[[Tree], Tree]
+Make = Callable[[Category, list[Tree], str], Tree]
+
+
+class Pass(ABC):
+    @property
+    def name(self) -> str:
+        # passes that rewrite differently must have different names
+        return type(self).__name__
+
+    @abstractmethod
+    def rewrite(self, node: Tree, view: View, make: Make) -> Tree:
+        """
+        Rewrite the internal node `node` and return it, or `node` itself if it
+        is unchanged. Leaves are never rewritten.
+        `view(child)` gives a descendant as this pass sees it, i.e. after the
+        earlier passes. Nodes created with `make` are still to be rewritten
+        by this pass; the children of the returned node are, too.
+        """
+
+
+class TypeRaise(Pass):
+    # apply_typeraise / en_apply_typeraise
+    def __init__(self, raisable: Callable[[Category, Category], bool]) -> None:
+        self.raisable = raisable
+
+    @property
+    def name(self) -> str:
+        return f"TypeRaise({self.raisable.__name__})"
+
+    def raised(self, comb: str, left: Category, right: Category) -> Optional[Category]:
+        # the category that the left child of a binary node is raised to, if
+        # it is: (X Y)< => (X'>T Y)>
+        if comb != "<" or not self.raisable(left, right):
+            return
+        return typeraise(left, right)
+
+    def rewrite(self, node: Tree, view: View, make: Make) -> Tree:
+        if not node.is_binary:
+            return node
+        left, right = node.children
+        cat = self.raised(node.comb, left.cat, right.cat)
+        if cat is None:
+            return node
+        return Tree(node.cat, [make(cat, [left], ">T"), right], ">")
+
+
+def rotation(
+    left: Category, middle: Category, right: Category
+) -> Optional[tuple[Category, str, Category, str]]:
+    # (X (Y Z)) => ((X Y) Z), if both compositions succeed: the category and
+    # combinator of (X Y), then of the whole
+    cat, comb = binary_comp(left, middle)
+    if not cat:
+        return
+    new_cat, new_comb = binary_comp(cat, right)
+    if not new_cat:
+        return
+    return cat, comb, new_cat, new_comb
+
+
+class RotateLeft(Pass):
+    # rotate2left
+    def rewrite(self, node: Tree, view: View, make: Make) -> Tree:
+        while node.is_binary:
+            right = view(node.right)
+            if not right.is_binary:
+                break
+            left, middle, right = view(node.left), view(right.left), view(right.right)
+            rotated = rotation(left.cat, middle.cat, right.cat)
+            if rotated is None:
+                break
+            cat, comb, new_cat, new_comb = rotated
+            node = make(new_cat, [make(cat, [left, middle], comb), right], new_comb)
+        return node
+
+
+class Pipeline:
+    def __init__(self, *passes: Pass) -> None:
+        self.passes: tuple[Pass, ...] = passes
+
+    @property
+    def name(self) -> str:
+        return " > ".join(p.name for p in self.passes)
+
+    def run(self, tree: Tree) -> Tree:
+        # rebuild only the nodes whose subtree changed
+        values: list[Tree] = []
+        for node in self.postorder(tree):
+            if not node.children:
+                values.append(node)
+                continue
+            n = len(node.children)
+            children = values[-n:]
+            del values[-n:]
+            if all(new is old for new, old in zip(children, node.children)):
+                values.append(node)
+            else:
+                values.append(Tree(node.cat, children, node.comb))
+        return values[0]
+
+    def postorder(
+        self,
+        tree: Tree,
+        skip: Optional[Callable[[Tree], bool]] = None,
+        done: Optional[Callable[[Tree], None]] = None,
+    ) -> Iterator[Tree]:
+        """
+        The nodes of `run(tree)` in postorder. Their categories and combinators
+        are final, but their children may not be.
+        `skip(node)` is asked of each internal input node that no pass has
+        rewritten when the traversal reaches it; if it is true, nothing is
+        yielded for the subtree. Otherwise `done(node)` is called after the
+        last node of the subtree's output.
+        """
+        final = len(self.passes)
+        # for each node created during the run, or rewritten by a pass, the
+        # pass it is waiting for (input nodes wait for the first one) and what
+        # that pass rewrote it into. Nodes that a pass leaves unchanged are not
+        # recorded; passes are deterministic, so they are just checked again.
+        # Entries keep their node alive, so that ids are not reused.
+        states: dict[int, tuple[Tree, int, Optional[Tree]]] = {}
+
+        def _view(level: int, node: Tree) -> Tree:
+            if node.children is None:
+                return node
+            state = states.get(id(node))
+            current = 0 if state is None else state[1]
+            while current < level:
+                result = None if state is None else state[2]
+                if result is None:
+                    result = rewrites[current](node, views[current], makes[current])
+                    if result is node:
+                        current += 1
+                        state = None
+                        continue
+                    states[id(node)] = (node, current, result)
+                node = result
+                current += 1
+                state = states.get(id(node))
+                if state is None or state[1] < current:
+                    state = states[id(node)] = (node, current, None)
+            return node
+
+        def _maker(level: int) -> Make:
+            def _make(cat: Category, children: list[Tree], comb: str) -> Tree:
+                node = Tree(cat, children, comb)
+                states[id(node)] = (node, level, None)
+                return node
+
+            return _make
+
+        rewrites = [p.rewrite for p in self.passes]
+        views = [partial(_view, level) for level in range(final)]
+        makes = [_maker(level) for level in range(final)]
+
+        # (node, visited), or (input node, None) to call `done` with
+        tasks: list[tuple[Tree, Optional[bool]]] = [(tree, False)]
+        while tasks:
+            node, visited = tasks.pop()
+            if visited is None:
+                done(node)
+                continue
+            if visited or not node.children:
+                yield node
+                continue
+            if skip is not None and id(node) not in states:
+                if skip(node):
+                    continue
+                if done is not None:
+                    tasks.append((node, None))
+            node = _view(final, node)
+            tasks.append((node, True))
+            tasks.extend([(child, False) for child in reversed(node.children)])
+
+
+JA_PREPROCESS = Pipeline(TypeRaise(raisable), RotateLeft())
+EN_PREPROCESS = Pipeline(TypeRaise(en_raisable), RotateLeft())
@@ -1,9 +1,18 @@
 # This script is based on https://github.com/masashi-y/depccg/blob/master/depccg/tools/reader.py
 
-from typing import Iterator, Optional
+import mmap
+import os
+import re
+import zipfile
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+from typing import Callable, Iterator, Optional
+
+import numpy as np
 from tree import Tree, printer
 from category import Category
-from grammar import binary_comp, PUNC, CONJ
+from grammar import binary_comp, coordination, unary_comp
 
 import logging
 
@@ -38,14 +47,40 @@ COMBINATORS: set[str] = {
     "NM",
     "ADV",
 }
-
-
-stack: list[Tree] = []
+# the labels of composition of any degree (see grammar.composition_label),
+# since the degrees allowed can be raised with grammar.set_max_degree
+COMPOSITION_LABEL = re.compile(r"[<>]Bx?\d*")
+
+
+class ReaderDiagnostics:
+    def __init__(self, max_mismatches: int = 0) -> None:
+        # derivations whose composed category disagrees with the gold one
+        # ("mismatch") or that no rule derives ("TC2"); only the last
+        # `max_mismatches` trees are kept
+        self.max_mismatches: int = max_mismatches
+        self.mismatches: deque[Tree] = deque(maxlen=max_mismatches)
+        self.counts: dict[str, int] = {"mismatch": 0, "TC2": 0}
+        # (parent, child) unary pairs with no registered rule, read as "TC"
+        self.unknown_unary: dict[tuple[str, str], int] = {}
+
+    def add_mismatch(self, tree: Tree, kind: str) -> None:
+        self.counts[kind] += 1
+        if self.max_mismatches:
+            self.mismatches.append(tree)
+
+    def merge(self, other: "ReaderDiagnostics") -> None:
+        for kind, count in other.counts.items():
+            self.counts[kind] += count
+        for key, count in other.unknown_unary.items():
+            self.unknown_unary[key] = self.unknown_unary.get(key, 0) + count
+        if self.max_mismatches:
+            self.mismatches.extend(other.mismatches)
 
 
 class AutoLineReader:
-    def __init__(self, line: str):
+    def __init__(self, line: str, diagnostics: Optional[ReaderDiagnostics] = None):
         self.line: str = line
+        self.diagnostics: ReaderDiagnostics = diagnostics or ReaderDiagnostics()
         self.index: int = 0
         self.word_id: int = -1
         self.binary_comp = binary_comp
@@ -65,7 +100,7 @@ class AutoLineReader:
         return self.line[self.index]
 
     def parse(self) -> Tree:
-        tree = self.next_node()
+        tree = self._next_node()
         return tree
 
     @property
@@ -99,7 +134,7 @@ class AutoLineReader:
         self._next()
         return Tree(cat, None, "lex", token)
 
-    def parse_tree(self) -> Tree:
+    def _parse_tree(self) -> Tree:
         self._check("(")
         self._check("<", 1)
         self._check("T", 2)
@@ -113,121 +148,199 @@ class AutoLineReader:
         self._next()
         if len(children) == 2:
             left, right = children
-            if left.cat == CONJ:
-                return Tree(cat, [left, right], ">")
+            comb = coordination(left.cat, right.cat, cat)
+            if comb == "punc":
+                return Tree(right.cat, [left, right], comb)
+            if comb is not None:
+                return Tree(cat, [left, right], comb)
             if "conj" in right.cat.features:
-                if left.cat.without_feature == right.cat.without_feature:
-                    return Tree(cat, [left, right], "<")
-                elif (
-                    left.cat in PUNC
-                    and right.cat.without_feature == cat.without_feature
-                ):
-                    return Tree(right.cat, [left, right], "punc")
-                else:
-                    if str(cat) == "GLUE":
-                        return Tree(cat, [left, right], "glue")
-                    raise ValueError(f"{printer(left)=}\n{printer(right)=}")
+                raise ValueError(f"{printer(left)=}\n{printer(right)=}")
             new_tree: Optional[Tree] = Tree.comp(left, right)
             if new_tree:
                 if new_tree.cat == cat:
                     return Tree(cat, [left, right], new_tree.comb)
                 else:
-                    stack.append(new_tree)
+                    self.diagnostics.add_mismatch(new_tree, "mismatch")
                     return Tree(cat, [left, right], new_tree.comb)
             else:
                 if str(cat) == "GLUE":
                     return Tree(cat, [left, right], "glue")
                 else:
-                    stack.append(Tree(cat, [left, right], "TC2"))
-                    return Tree(cat, [left, right], "TC2")
+                    tree = Tree(cat, [left, right], "TC2")
+                    self.diagnostics.add_mismatch(tree, "TC2")
+                    return tree
 
         elif len(children) == 1:
-            if cat.without_feature == Category.from_string("NP") and children[
-                0
-            ].cat.without_feature == Category.from_string("N"):
-                comb = "NM"
-            elif cat.without_feature == Category.from_string("S/(S\\NP)") and children[
-                0
-            ].cat.without_feature == Category.from_string("NP"):
-                comb = ">T"
-            elif cat.without_feature == Category.from_string("NP\\NP") and children[
-                0
-            ].cat.without_feature == Category.from_string("S\\NP"):
-                comb = "ADN"
-            elif cat.without_feature == Category.from_string("N\\N") and children[
-                0
-            ].cat.without_feature == Category.from_string("S\\NP"):
-                comb = "ADN"
-            elif cat.without_feature == Category.from_string(
-                "(S\\NP)\\(S\\NP)"
-            ) and children[0].cat.without_feature == Category.from_string("S\\NP"):
-                comb = "ADV"
-            elif cat.without_feature == Category.from_string("S\\NP") and children[
-                0
-            ].cat.without_feature == Category.from_string("NP"):
-                comb = "TC"
-            elif cat.without_feature == Category.from_string("S\\NP") and children[
-                0
-            ].cat.without_feature == Category.from_string("N"):
-                comb = "TC"
-            elif cat.without_feature == Category.from_string("S\\NP") and children[
-                0
-            ].cat.without_feature == Category.from_string("S/(S/NP)"):
-                comb = "TC"
-            elif cat.without_feature == Category.from_string("S\\NP") and children[
-                0
-            ].cat.without_feature == Category.from_string("NP\\NP"):
-                comb = "TC"
-            elif cat.without_feature == Category.from_string("S\\NP") and children[
-                0
-            ].cat.without_feature == Category.from_string("N\\N"):
+            comb: Optional[str] = unary_comp(cat, children[0].cat)
+            if comb is None:
                 comb = "TC"
-            elif cat.without_feature == Category.from_string("S\\NP") and children[
-                0
-            ].cat.without_feature == Category.from_string("S/(S\\NP)"):
-                comb = "TC"
-            elif cat.without_feature == Category.from_string("S\\NP") and children[
-                0
-            ].cat.without_feature == Category.from_string("(S\\NP)\\(S\\NP)"):
-                comb = "TC"
-            elif cat.without_feature == Category.from_string("NP") and children[
-                0
-            ].cat.without_feature == Category.from_string("(S\\NP)\\(S\\NP)"):
-                comb = "TC"
-            elif cat.without_feature == Category.from_string("N") and children[
-                0
-            ].cat.without_feature == Category.from_string("(S\\NP)\\(S\\NP)"):
-                comb = "TC"
-            elif cat.without_feature == Category.from_string("S/NP") and children[
-                0
-            ].cat.without_feature == Category.from_string("N\\N"):
-                comb = "TC"
-            else:
-                comb = "TC"
-                print(f"{str(children[0].cat)=}")
-                print(f"{str(cat)=}")
+                key = (str(cat.without_feature), str(children[0].cat.without_feature))
+                unknown = self.diagnostics.unknown_unary
+                unknown[key] = unknown.get(key, 0) + 1
             return Tree(cat, children, comb)
         else:
             raise RuntimeError(f"failed to parse:\n{children=}\n{self.line=}")
 
 
-def read_auto(filename: str) -> Iterator[Tree]:
-    for line in open(filename):
-        line = line.strip()
-        if len(line) == 0:
-            continue
-        tree = AutoLineReader(line).parse()
-        yield tree
-
-
-def read_parsedJaTree(filepath: str) -> Iterator[Tree]:
+def read_lines(filepath: str) -> Iterator[str]:
+    # the non-empty lines of a parse file, stripped
     with open(filepath, "r") as f:
         for line in f:
             line = line.strip()
             if len(line) == 0:
                 continue
+            yield line
+
+
+def parse_auto_line(line: str) -> Tree:
+    return AutoLineReader(line).parse()
+
+
+def parse_ja_line(line: str) -> Tree:
+    return JaReader(line).parse()
+
+
+def _parse_auto_diagnostics(
+    line: str, max_mismatches: int = 0
+) -> tuple[Tree, ReaderDiagnostics]:
+    diagnostics = ReaderDiagnostics(max_mismatches)
+    return AutoLineReader(line, diagnostics).parse(), diagnostics
+
+
+def imap_lines(
+    func: Callable, lines: Iterator[str], processes: int, chunksize: int
+) -> Iterator:
+    # `func` applied to `lines` by a pool of `processes` processes; results
+    # come back in input order. `func` must be a module-level function
+    with Pool(processes) as pool:
+        yield from pool.imap(func, lines, chunksize)
+
+
+def read_auto(
+    filename: str,
+    diagnostics: Optional[ReaderDiagnostics] = None,
+    processes: Optional[int] = None,
+    chunksize: int = 16,
+) -> Iterator[Tree]:
+    diagnostics = diagnostics or ReaderDiagnostics()
+    if processes is None:
+        for line in read_lines(filename):
+            tree = AutoLineReader(line, diagnostics).parse()
+            yield tree
+    else:
+        parse = partial(
+            _parse_auto_diagnostics, max_mismatches=diagnostics.max_mismatches
+        )
+        for tree, line_diagnostics in imap_lines(
+            parse, read_lines(filename), processes, chunksize
+        ):
+            diagnostics.merge(line_diagnostics)
+            yield tree
+
+
+def read_parsedJaTree(
+    filepath: str, processes: Optional[int] = None, chunksize: int = 16
+) -> Iterator[Tree]:
+    if processes is None:
+        for line in read_lines(filepath):
             tree = JaReader(line).parse()
             yield tree
+    else:
+        yield from imap_lines(parse_ja_line, read_lines(filepath), processes, chunksize)
+
+
+class Treebank:
+    """
+    Random access to the trees of a parse file: the file is memory-mapped,
+    an index of the byte offsets of its non-empty lines is built (or loaded
+    from `index_path`), and a tree is parsed only when its line is requested.
+
+        treebank = Treebank("Dundee.txt")
+        treebank[1800], treebank[100:200], len(treebank)
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        parse: Optional[Callable[[str], Tree]] = None,
+        index_path: Optional[str] = None,
+    ) -> None:
+        self.filepath: str = filepath
+        self.parse: Callable[[str], Tree] = parse or (
+            lambda line: AutoLineReader(line).parse()
+        )
+        self._file = open(filepath, "rb")
+        stat = os.fstat(self._file.fileno())
+        # an index is reused only for the same size and modification time
+        version = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        # mmap cannot map an empty file
+        self._mmap: mmap.mmap | bytes = b""
+        if stat.st_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets: np.ndarray = self._load_index(index_path, version)
+        if self.offsets is None:
+            self.offsets = self._build_index()
+            if index_path:
+                with open(index_path, "wb") as f:
+                    np.savez(f, offsets=self.offsets, version=version)
+
+    def _load_index(
+        self, index_path: Optional[str], version: np.ndarray
+    ) -> Optional[np.ndarray]:
+        if not index_path or not os.path.exists(index_path):
+            return
+        try:
+            with np.load(index_path) as index:
+                if not np.array_equal(index["version"], version):
+                    return
+                return index["offsets"]
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # an index of an older format, or broken: built again
+            return
+
+    def _build_index(self) -> np.ndarray:
+        # (start, end) byte offsets of each non-empty line
+        offsets: list[tuple[int, int]] = []
+        start, size = 0, len(self._mmap)
+        while start < size:
+            end = self._mmap.find(b"\n", start)
+            if end < 0:
+                end = size
+            if self._mmap[start:end].strip():
+                offsets.append((start, end))
+            start = end + 1
+        return np.array(offsets, dtype=np.int64).reshape(-1, 2)
+
+    def line(self, i: int) -> str:
+        start, end = self.offsets[i]
+        return self._mmap[start:end].decode().strip()
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, i: int | slice) -> Tree | list[Tree]:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"tree index out of range: {i}")
+        return self.parse(self.line(i))
+
+    def __iter__(self) -> Iterator[Tree]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self) -> None:
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> "Treebank":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
 
 
 def read_parsedJaString(strings: list[str]) -> Iterator[Tree]:
@@ -265,7 +378,8 @@ class JaReader:
     @property
     def _next_node(self):
         end = self.line.find(" ", self.index)  # end = " "が現れるindex
-        if self.line[self.index + 1 : end] in COMBINATORS:
+        label = self.line[self.index + 1 : end]
+        if label in COMBINATORS or COMPOSITION_LABEL.fullmatch(label):
             return self._parse_tree
         else:
             return self._parse_terminal
@@ -1,10 +1,10 @@
 # This script is based on https://github.com/masashi-y/depccg/blob/master/depccg/tree.py
 
 
-import re
+from collections import OrderedDict
 from typing import Optional
 
-from category import Category, Complex
+from category import ONE_S, S_HEADED, Category, Complex
 from grammar import binary_comp, ba
 
 # constraint
@@ -15,6 +15,16 @@ ROOT_CATS: set[Category] = {
 }
 
 
+# the leaves of a sentence and their tokens, shared by all of its subtrees,
+# and the range of them that a subtree spans
+Span = tuple[list["Tree"], list[str], int, int]
+
+# entries of SubtreeCache, i.e. distinct (kind, subtree) pairs
+SUBTREE_CACHE_SIZE: int = 1 << 16
+# ids of the structures of subtrees, see Tree.structure
+STRUCTURES: dict[tuple[int, str, tuple[int, ...]], int] = {}
+
+
 class Tree:
     def __init__(
         self,
@@ -28,30 +38,99 @@ class Tree:
         self.children = children
         self.comb = comb
         self.token = token
+        self._structure: Optional[int] = None
+        # computed on demand, or here when the children span adjacent ranges
+        # of the same sentence, as they do when a transform regroups them
+        self._span: Optional[Span] = None
+        if children:
+            first = children[0]._span
+            if first is not None:
+                leaves, tokens, start, end = first
+                for child in children[1:]:
+                    span = child._span
+                    if span is None or span[0] is not leaves or span[2] != end:
+                        break
+                    end = span[3]
+                else:
+                    self._span = (leaves, tokens, start, end)
+
+    def _compute_span(self) -> Span:
+        if self._span is not None:
+            return self._span
+        leaves: list["Tree"] = []
+        tokens: list[str] = []
+        # subtrees that already have a span are copied from it, the others
+        # get spans into the new lists
+        stack: list[tuple["Tree", int]] = [(self, -1)]
+        while stack:
+            node, start = stack.pop()
+            if start >= 0:
+                node._span = (leaves, tokens, start, len(leaves))
+            elif node._span is not None:
+                node_leaves, node_tokens, node_start, node_end = node._span
+                leaves.extend(node_leaves[node_start:node_end])
+                tokens.extend(node_tokens[node_start:node_end])
+            elif node.children:
+                stack.append((node, len(leaves)))
+                stack.extend((child, -1) for child in reversed(node.children))
+            else:
+                node._span = (leaves, tokens, len(leaves), len(leaves) + 1)
+                leaves.append(node)
+                tokens.append(node.token)
+        return self._span
 
     @property
-    def leaves(self) -> list["Tree"]:
-        def rec(tree: "Tree") -> None:
-            assert isinstance(tree, Tree), f"{tree=}"
-            if tree.children:
-                for child in tree.children:
-                    rec(child)
+    def structure(self) -> int:
+        """
+        The id of the structure of the subtree: two subtrees have the same id
+        exactly when they have the same categories and combinators in the same
+        shape. Tokens are left out. Ids are interned in STRUCTURES, computed
+        bottom-up from the category and combinator of each node and the ids of
+        its children, and are valid within the process.
+        """
+        tasks: list[tuple[Tree, bool]] = [(self, False)]
+        while tasks:
+            node, visited = tasks.pop()
+            if visited:
+                children = tuple(child._structure for child in node.children)
+            elif node._structure is not None:
+                continue
+            elif node.children:
+                tasks.append((node, True))
+                tasks.extend((child, False) for child in node.children)
+                continue
             else:
-                result.append(tree)
+                children = ()
+            key = (node.cat.id, node.comb, children)
+            node._structure = STRUCTURES.setdefault(key, len(STRUCTURES))
+        return self._structure
 
-        result: list["Tree"] = []
-        rec(self)
-        return result
+    @property
+    def span(self) -> tuple[int, int]:
+        # the range of the sentence's leaves that this subtree covers
+        _, _, start, end = self._compute_span()
+        return start, end
+
+    @property
+    def leaves(self) -> list["Tree"]:
+        if not self.children:
+            return [self]
+        leaves, _, start, end = self._compute_span()
+        return leaves[start:end]
 
     @property
     def tokens(self) -> list[str]:
-        return [leaf.token for leaf in self.leaves if isinstance(leaf.token, str)]
+        if not self.children:
+            return [self.token] if self.is_terminal else []
+        _, tokens, start, end = self._compute_span()
+        return tokens[start:end]
 
     @property
     def rightmost_token(self) -> str:
         if self.is_terminal:
             return self.token
-        return self.tokens[-1]
+        _, tokens, _, end = self._compute_span()
+        return tokens[end - 1]
 
     @property
     def terminal_cat(self) -> list[str]:
@@ -59,11 +138,7 @@ class Tree:
 
     @property
     def terminal_token_cat(self) -> list[tuple[str, Category]]:
-        return [
-            (leaf.token, leaf.cat)
-            for leaf in self.leaves
-            if isinstance(leaf.token, str)
-        ]
+        return [(leaf.token, leaf.cat) for leaf in self.leaves]
 
     @property
     def is_terminal(self) -> bool:
@@ -71,7 +146,7 @@ class Tree:
 
     @property
     def word(self) -> str:
-        return " ".join(token for token in self.tokens)
+        return " ".join(self.tokens)
 
     @property
     def left(self) -> "Tree":
@@ -112,25 +187,78 @@ class Tree:
         return
 
 
+class SubtreeCache:
+    """
+    A bounded LRU cache of values computed from subtrees, such as the code
+    vectors of count.NodeTable, keyed by the kind of value and the structure
+    of the subtree. `stats` gives the hit rate of each kind.
+    """
+
+    def __init__(self, maxsize: int = SUBTREE_CACHE_SIZE) -> None:
+        self.maxsize: int = maxsize
+        self.entries: OrderedDict[tuple[str, int], object] = OrderedDict()
+        self.hits: dict[str, int] = {}
+        self.misses: dict[str, int] = {}
+
+    def get(self, kind: str, structure: int) -> Optional[object]:
+        key = (kind, structure)
+        value = self.entries.get(key)
+        if value is None:
+            self.misses[kind] = self.misses.get(kind, 0) + 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits[kind] = self.hits.get(kind, 0) + 1
+        return value
+
+    def put(self, kind: str, structure: int, value: object) -> None:
+        key = (kind, structure)
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.hits.clear()
+        self.misses.clear()
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        stats: dict[str, dict[str, float]] = {}
+        for kind in sorted(self.hits.keys() | self.misses.keys()):
+            hits, misses = self.hits.get(kind, 0), self.misses.get(kind, 0)
+            stats[kind] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses),
+            }
+        return stats
+
+
 def typeraise(left: Category, right: Complex) -> Complex:
     return Complex(right.left, "/", Complex(right.left, "\\", left))
 
 
+def raisable(left: Category, right: Category) -> bool:
+    # the left argument of a "<" node is type-raised when the functor is
+    # headed by S and includes just one S
+    return right.flags & (S_HEADED | ONE_S) == S_HEADED | ONE_S
+
+
+def en_raisable(left: Category, right: Category) -> bool:
+    return ba(left, right) is not None
+
+
 def apply_typeraise(tree: Tree) -> Tree:
     def _apply_typeraise(node: Tree) -> Tree:
         if node.is_terminal:
-            return Tree(node.cat, None, "lex", node.token)
+            return node
         elif node.is_unary:
             return Tree(
                 node.cat,
                 [_apply_typeraise(node.child)],
                 node.comb,
             )
-        elif (
-            node.comb == "<"
-            and re.match(r"(\(*)S", str(node.right.cat)) is not None
-            and str(node.right.cat).count("S") == 1
-        ):
+        elif node.comb == "<" and raisable(node.left.cat, node.right.cat):
             return Tree(
                 node.cat,
                 [
@@ -156,14 +284,14 @@ def apply_typeraise(tree: Tree) -> Tree:
 def en_apply_typeraise(tree: Tree) -> Tree:
     def _apply_typeraise(node: Tree) -> Tree:
         if node.is_terminal:
-            return Tree(node.cat, None, "lex", node.token)
+            return node
         elif node.is_unary:
             return Tree(
                 node.cat,
                 [_apply_typeraise(node.child)],
                 node.comb,
             )
-        elif node.comb == "<" and ba(node.left.cat, node.right.cat):
+        elif node.comb == "<" and en_raisable(node.left.cat, node.right.cat):
             return Tree(
                 node.cat,
                 [
@@ -187,30 +315,36 @@ def en_apply_typeraise(tree: Tree) -> Tree:
 
 
 def rotate2left(tree: Tree) -> Tree:
-    def _rotate2left(node: Tree) -> Tree:
+    # Iterative version of the recursive rotation: `tasks` holds the nodes
+    # still to rotate and the nodes to rebuild from the results on `values`,
+    # so deep right-branching trees do not hit the recursion limit. Leaves
+    # are shared with the input, so the spans of its subtrees carry over.
+    tasks: list[tuple[Tree, bool]] = [(tree, False)]
+    values: list[Tree] = []
+    while tasks:
+        node, rebuild = tasks.pop()
+        if rebuild:
+            n = len(node.children)
+            children = values[-n:]
+            del values[-n:]
+            values.append(Tree(node.cat, children, node.comb))
+            continue
+        while node.is_binary and node.right.is_binary:
+            # (X (Y Z)) => ((X Y) Z), if both compositions succeed
+            left, middle, right = node.left, node.right.left, node.right.right
+            cat, comb = binary_comp(left.cat, middle.cat)
+            if not cat:
+                break
+            new_cat, new_comb = binary_comp(cat, right.cat)
+            if not new_cat:
+                break
+            node = Tree(new_cat, [Tree(cat, [left, middle], comb), right], new_comb)
         if node.is_terminal:
-            return Tree(node.cat, None, "lex", node.token)
-        elif node.is_unary:
-            return Tree(node.cat, [_rotate2left(node.children[0])], node.comb)
-        else:  # node.is_binary
-            if node.right.is_binary:
-                new_node: Optional[Tree] = Tree.comp(
-                    Tree.comp(node.left, node.right.left), node.right.right
-                )
-                if new_node:
-                    return _rotate2left(new_node)
-                return Tree(
-                    node.cat,
-                    [_rotate2left(node.left), _rotate2left(node.right)],
-                    node.comb,
-                )
-            return Tree(
-                node.cat,
-                [_rotate2left(node.left), _rotate2left(node.right)],
-                node.comb,
-            )
-
-    return _rotate2left(tree)
+            values.append(node)
+        else:
+            tasks.append((node, True))
+            tasks.extend((child, False) for child in reversed(node.children))
+    return values[0]
 
 
 def printer(tree: Tree) -> str:
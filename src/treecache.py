@@ -0,0 +1,104 @@
+"""
+Compact on-disk cache of parsed trees.
+
+Trees are stored as the columns of a flattree.FlatCorpus (see
+FlatCorpus.to_arrays): the nodes of every tree in postorder with a category,
+a combinator, the start of the node's subtree and a token index (-1 for
+internal nodes), plus the tables of strings that categories and combinators
+refer to. The cache records the SHA-256 of the parse file it was built from
+and a fingerprint of the grammar it was read with, and is rebuilt when either
+changes or when it cannot be loaded.
+
+    trees = read_cached("../data/parse/Dundee.txt")
+    trees = read_cached("../data/parse/BCCWJ-EyeTrack.txt", read_parsedJaTree)
+"""
+
+import hashlib
+import os
+import zipfile
+from typing import Callable, Iterable, Iterator, Optional
+
+import numpy as np
+
+from flattree import FlatCorpus
+from grammar import grammar_fingerprint
+from reader import read_auto
+from tree import Tree
+
+FORMAT_VERSION: int = 3
+
+
+def file_hash(filepath: str) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_trees(
+    trees: Iterable[Tree], cache_path: str, source_hash: str = "", grammar: str = ""
+) -> None:
+    arrays = FlatCorpus.from_trees(trees).to_arrays()
+    # written next to the cache and moved into place, so that readers never
+    # see a partly written cache
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                version=FORMAT_VERSION,
+                source_hash=source_hash,
+                grammar=grammar,
+                **arrays,
+            )
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_corpus(
+    cache_path: str, source_hash: Optional[str] = None, grammar: Optional[str] = None
+) -> Optional[FlatCorpus]:
+    # None when there is no cache, or it is stale, of another format or broken
+    if not os.path.exists(cache_path):
+        return
+    try:
+        with np.load(cache_path) as cache:
+            if int(cache["version"]) != FORMAT_VERSION:
+                return
+            if source_hash is not None and str(cache["source_hash"]) != source_hash:
+                return
+            if grammar is not None and str(cache["grammar"]) != grammar:
+                return
+            return FlatCorpus.from_arrays(cache)
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        return
+
+
+def cached_corpus(
+    filepath: str,
+    read: Callable[[str], Iterator[Tree]] = read_auto,
+    cache_path: Optional[str] = None,
+) -> FlatCorpus:
+    # the trees in `filepath` as a FlatCorpus, parsing it only if the cache
+    # is missing or unreadable, or was built from a different version of the
+    # file or with different grammar settings
+    cache_path = cache_path or f"{filepath}.trees.npz"
+    source_hash = file_hash(filepath)
+    grammar = grammar_fingerprint()
+    corpus = load_corpus(cache_path, source_hash, grammar)
+    if corpus is None:
+        save_trees(read(filepath), cache_path, source_hash, grammar)
+        corpus = load_corpus(cache_path, source_hash, grammar)
+    return corpus
+
+
+def read_cached(
+    filepath: str,
+    read: Callable[[str], Iterator[Tree]] = read_auto,
+    cache_path: Optional[str] = None,
+) -> list[Tree]:
+    return list(cached_corpus(filepath, read, cache_path).to_trees())
@@ -0,0 +1,231 @@
+"""
+Validation of read derivations against the rules of grammar.py.
+
+Every binary node of a tree is derived again from the categories of its
+children, with the rules of AutoLineReader for AUTO trees (grammar.coordination
+and glue, then binary_comp) and with binary_comp for Japanese trees, and every
+unary node is looked up in UNARY_RULES, or JA_UNARY_RULES for Japanese trees;
+nodes whose category or combinator disagrees are reported per sentence and per
+combinator of the tree:
+
+    report = validate_auto("../data/parse/Dundee.txt", processes=4)
+    report.summary(), report.sentences[i]
+
+The trees are read in a process pool, which sends back the category strings
+of their nodes. The rules are then checked once per distinct pair of the whole
+corpus, with batchcomp.batch_binary_comp, so that the workers share one memo
+instead of deriving each pair again in every process.
+
+    python validate.py ../data/parse/Dundee.txt
+    python validate.py ../data/parse/BCCWJ-EyeTrack.txt --ja
+"""
+
+import argparse
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+
+from batchcomp import batch_binary_comp
+from category import Category
+from flattree import COMB_LABELS
+from grammar import JA_UNARY_RULES, UNARY_RULES, coordination, unary_comp
+from reader import AutoLineReader, JaReader, imap_lines, read_lines
+from tree import Tree
+
+# (begin, end, combinator, category, child categories) of an internal node
+Node = tuple[int, int, str, str, tuple[str, ...]]
+# (begin, end, combinator, category, kind, derived combinator, derived category)
+Mismatch = tuple[int, int, str, str, str, Optional[str], Optional[str]]
+
+# kinds of mismatch
+KINDS: tuple[str, ...] = (
+    # a binary node that no rule derives
+    "underivable",
+    # a binary node for which the rule derives a different category
+    "category",
+    # the category is derived, but by a different combinator
+    "combinator",
+    # a unary node with no registered rule
+    "unregistered",
+)
+
+
+def tree_nodes(tree: Tree) -> list[Node]:
+    # the internal nodes of a tree, in preorder
+    nodes: list[Node] = []
+    # the spans of all the subtrees, in one traversal
+    tree._compute_span()
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if not node.children:
+            continue
+        begin, end = node.span
+        children = tuple(str(child.cat) for child in node.children)
+        nodes.append((begin, end, node.comb, str(node.cat), children))
+        stack.extend(reversed(node.children))
+    return nodes
+
+
+def _auto_nodes(line: str) -> list[Node]:
+    return tree_nodes(AutoLineReader(line).parse())
+
+
+def _ja_nodes(line: str) -> list[Node]:
+    return tree_nodes(JaReader(line).parse())
+
+
+class ValidationReport:
+    """
+    `sentences[i]`: the mismatches of the i-th tree; `nodes[comb]`: the number
+    of nodes with that combinator, and `mismatches[comb][kind]` how many of
+    them disagree with the grammar.
+    """
+
+    __slots__ = ("sentences", "nodes", "mismatches")
+
+    def __init__(self) -> None:
+        self.sentences: list[list[Mismatch]] = []
+        self.nodes: dict[str, int] = {}
+        self.mismatches: dict[str, dict[str, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.sentences)
+
+    @property
+    def num_mismatches(self) -> int:
+        return sum(len(mismatches) for mismatches in self.sentences)
+
+    @property
+    def invalid(self) -> list[int]:
+        # the sentences with at least one mismatch
+        return [i for i, mismatches in enumerate(self.sentences) if mismatches]
+
+    def summary(self) -> dict[str, dict[str, int]]:
+        # per combinator: its nodes and their mismatches of each kind
+        return {
+            comb: {"nodes": count, **self.mismatches.get(comb, {})}
+            for comb, count in sorted(self.nodes.items(), key=lambda i: -i[1])
+        }
+
+
+def validate(sentences: list[list[Node]], japanese: bool = False) -> ValidationReport:
+    """
+    Check the nodes of each sentence (see tree_nodes) against the rules that
+    the reader of their format applies.
+    """
+    report = ValidationReport()
+    # the distinct category pairs of binary nodes, as ids
+    pair_index: dict[tuple[str, str], int] = {}
+    for nodes in sentences:
+        for _, _, comb, _, children in nodes:
+            report.nodes[comb] = report.nodes.get(comb, 0) + 1
+            if len(children) == 2 and children not in pair_index:
+                pair_index[children] = len(pair_index)
+    left = np.array([Category.from_string(cat).id for cat, _ in pair_index], dtype=int)
+    right = np.array([Category.from_string(cat).id for _, cat in pair_index], dtype=int)
+    results, codes = batch_binary_comp(left, right)
+    derived: list[tuple[Optional[Category], Optional[str]]] = [
+        (Category.from_id(result), COMB_LABELS[code]) if code >= 0 else (None, None)
+        for result, code in zip(results.tolist(), codes.tolist())
+    ]
+
+    unary_rules = JA_UNARY_RULES if japanese else UNARY_RULES
+
+    for nodes in sentences:
+        mismatches: list[Mismatch] = []
+        for begin, end, comb, cat, children in nodes:
+            if len(children) == 2:
+                result, label = derived[pair_index[children]]
+                if not japanese:
+                    # the steps that AutoLineReader takes before the rules
+                    left, right = map(Category.from_string, children)
+                    step = coordination(left, right, Category.from_string(cat))
+                    if step is not None:
+                        result, label = Category.from_string(cat), step
+                    elif result is None and cat == "GLUE":
+                        result, label = Category.from_string(cat), "glue"
+                if result is None:
+                    kind = "underivable"
+                elif result != Category.from_string(cat):
+                    kind = "category"
+                elif label != comb:
+                    kind = "combinator"
+                else:
+                    continue
+                result = str(result) if result is not None else None
+            else:
+                label = unary_comp(
+                    Category.from_string(cat),
+                    Category.from_string(children[0]),
+                    unary_rules,
+                )
+                if label is None:
+                    kind = "unregistered"
+                elif label != comb:
+                    kind = "combinator"
+                else:
+                    continue
+                result = cat if label is not None else None
+            mismatches.append((begin, end, comb, cat, kind, label, result))
+            counts = report.mismatches.setdefault(comb, {})
+            counts[kind] = counts.get(kind, 0) + 1
+        report.sentences.append(mismatches)
+    return report
+
+
+def _read_nodes(
+    parse: Callable[[str], list[Node]],
+    filepath: str,
+    processes: Optional[int],
+    chunksize: int,
+) -> Iterator[list[Node]]:
+    if processes is None:
+        return map(parse, read_lines(filepath))
+    return imap_lines(parse, read_lines(filepath), processes, chunksize)
+
+
+def validate_auto(
+    filepath: str, processes: Optional[int] = None, chunksize: int = 16
+) -> ValidationReport:
+    return validate(list(_read_nodes(_auto_nodes, filepath, processes, chunksize)))
+
+
+def validate_ja(
+    filepath: str, processes: Optional[int] = None, chunksize: int = 16
+) -> ValidationReport:
+    sentences = list(_read_nodes(_ja_nodes, filepath, processes, chunksize))
+    return validate(sentences, japanese=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("filepath", help="parse file")
+    parser.add_argument(
+        "--ja", action="store_true", help="the file is a Japanese CCGBank file"
+    )
+    parser.add_argument("--processes", type=int, help="size of the process pool")
+    parser.add_argument("--chunksize", type=int, default=16)
+    parser.add_argument(
+        "--show", type=int, default=0, help="print the mismatches of N sentences"
+    )
+    args = parser.parse_args()
+
+    run = validate_ja if args.ja else validate_auto
+    report = run(args.filepath, args.processes, args.chunksize)
+    invalid = report.invalid
+    print(
+        f"sentences: {len(report)}, invalid: {len(invalid)}, "
+        f"mismatches: {report.num_mismatches}"
+    )
+    for comb, counts in report.summary().items():
+        kinds = ", ".join(f"{kind} {counts[kind]}" for kind in KINDS if kind in counts)
+        print(f"{comb:>8}: {counts['nodes']:>7} nodes  {kinds}")
+    for i in invalid[: args.show]:
+        print(f"sentence {i}:")
+        for begin, end, comb, cat, kind, label, result in report.sentences[i]:
+            print(f"  {begin}-{end} {comb} {cat}: {kind} ({label} {result})")
+
+
+if __name__ == "__main__":
+    main()